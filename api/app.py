@@ -1,21 +1,146 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, Response, g, render_template, request, jsonify, send_from_directory, send_file, stream_with_context, url_for, abort
+import json
 import os
-import io
 import requests
-from PIL import Image
 from werkzeug.utils import secure_filename
+import time
 import uuid
 from urllib.parse import urlparse
-import base64
+
+from gifcore.clips import Clip, clip_options, sampled_frames
+from gifcore.fetch import FetchError, fetch_many, fetch_to_store
+from gifcore.formats import OutputFormat
+from gifcore.ingest import IngestPool
+from gifcore.janitor import Janitor, mark_used
+from gifcore.metrics import default_metrics, record_render
+from gifcore.normalize import Normalizer
+from gifcore.parallel import iter_segments
+from gifcore.previews import ThumbnailStore
+from gifcore.quantize import Quantizer
+from gifcore.rendercache import SingleFlight, content_digest, render_key
+from gifcore.segments import AnimationStream, SegmentCache, SegmentStream, segment_keys
+from gifcore.sessions import open_session_store
+from gifcore.store import BlobStore, ImageCache, RawImageStore
+from gifcore.timeline import Timeline
+from gifcore.trace import Trace, span, traced, tracing
+from gifcore.transitions import SCALE_QUALITIES, TRANSITION_TYPES, transition_frame_count
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['OUTPUT_FOLDER'] = 'output'
+app.config['IMAGE_CACHE_BYTES'] = int(os.environ.get('IMAGE_CACHE_BYTES', 256 * 1024 * 1024))
+app.config['RENDER_PROCESSES'] = int(os.environ.get('RENDER_PROCESSES', 1))
+app.config['PALETTE_MODE'] = os.environ.get('PALETTE_MODE', 'frame')
+app.config['QUANTIZER'] = os.environ.get('QUANTIZER', 'mediancut')
+app.config['MAX_DIMENSION'] = int(os.environ.get('MAX_DIMENSION', 1024))
+app.config['FIT_MODE'] = os.environ.get('FIT_MODE', 'contain')
+app.config['SCALE_QUALITY'] = os.environ.get('SCALE_QUALITY', 'fast')
+app.config['OUTPUT_FORMAT'] = os.environ.get('OUTPUT_FORMAT', 'gif')
+app.config['CLIP_MAX_FRAMES'] = int(os.environ.get('CLIP_MAX_FRAMES', 300))
+app.config['FETCH_MAX_BYTES'] = int(os.environ.get('FETCH_MAX_BYTES', 20 * 1024 * 1024))
+app.config['FETCH_CONCURRENCY'] = int(os.environ.get('FETCH_CONCURRENCY', 8))
+app.config['FETCH_BATCH_LIMIT'] = 50
+app.config['INGEST_WORKERS'] = int(os.environ.get('INGEST_WORKERS', os.cpu_count() or 1))
+app.config['UPLOAD_BATCH_LIMIT'] = 50
+app.config['SESSION_STORE'] = os.environ.get('SESSION_STORE', 'memory')
+app.config['SESSION_DB'] = os.environ.get('SESSION_DB', os.path.join(app.config['UPLOAD_FOLDER'], 'sessions', 'sessions.db'))
+app.config['SESSION_TTL'] = int(os.environ.get('SESSION_TTL', 24 * 60 * 60))
+app.config['UPLOAD_GRACE'] = int(os.environ.get('UPLOAD_GRACE', 60 * 60))
+app.config['OUTPUT_TTL'] = int(os.environ.get('OUTPUT_TTL', 24 * 60 * 60))
+app.config['OUTPUT_QUOTA_BYTES'] = int(os.environ.get('OUTPUT_QUOTA_BYTES', 1024 * 1024 * 1024))
+app.config['JANITOR_INTERVAL'] = int(os.environ.get('JANITOR_INTERVAL', 300))
+app.config['SEGMENT_CACHE_BYTES'] = int(os.environ.get('SEGMENT_CACHE_BYTES', 512 * 1024 * 1024))
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 
-session_storage = {}
+# Sessions are kept in memory by default. Set SESSION_STORE=sqlite to share
+# them between processes.
+session_store = open_session_store(app.config['SESSION_STORE'], app.config['SESSION_DB'])
+
+# Transitions draw the next image over the current one, which renders
+# differently from the push transitions of app.py
+RENDERER = 'overlay'
+
+# Identical renders running at the same time are only done once
+render_flights = SingleFlight()
+
+# Thumbnails never change, so let browsers keep them for a year
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60
+
+# Nor do rendered GIFs, which are named after what went into them
+OUTPUT_MAX_AGE = 365 * 24 * 60 * 60
+
+upload_store = BlobStore(app.config['UPLOAD_FOLDER'])
+thumbnail_store = ThumbnailStore(os.path.join(app.config['UPLOAD_FOLDER'], 'thumbs'))
+image_cache = ImageCache(app.config['IMAGE_CACHE_BYTES'])
+
+# Uploads of a batch are processed on a pool shared by every request. Its
+# threads only work while an upload request is streaming its results, so
+# nothing is left running once a response is done.
+ingest_pool = IngestPool(app.config['INGEST_WORKERS'])
+
+# Uploads decoded once, as they arrive, into raw pixels renders can map
+# instead of decoding the file again
+raw_store = RawImageStore(os.path.join(app.config['UPLOAD_FOLDER'], 'raw'), app.config['MAX_DIMENSION'])
+
+# Encoded segments of earlier renders, so a GIF that differs from one made
+# before in a single image or transition only renders the parts that changed
+segment_cache = SegmentCache(
+    os.path.join(app.config['OUTPUT_FOLDER'], 'segments'),
+    app.config['SEGMENT_CACHE_BYTES']
+)
+
+
+# Expire old sessions and delete files nothing needs any more. Vercel
+# freezes the process between requests, so renders run inside their request
+# and the janitor runs at the start of the first request after each interval
+# rather than on a thread of its own.
+janitor = Janitor(
+    session_store,
+    upload_store,
+    app.config['OUTPUT_FOLDER'],
+    thumbnails=thumbnail_store,
+    jobs=None,
+    segments=segment_cache,
+    raws=raw_store,
+    session_ttl=app.config['SESSION_TTL'],
+    upload_grace=app.config['UPLOAD_GRACE'],
+    output_ttl=app.config['OUTPUT_TTL'],
+    output_quota=app.config['OUTPUT_QUOTA_BYTES'],
+    interval=app.config['JANITOR_INTERVAL']
+)
+
+# Request latencies and render stages, served at /metrics
+metrics = default_metrics()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.before_request
+def clean_up():
+    try:
+        janitor.run_if_due()
+    except Exception:
+        app.logger.exception("Janitor run failed")
+
+
+@app.after_request
+def record_request_time(response):
+    # Streamed responses are timed up to their first chunk
+    start = g.pop('request_start', None)
+    if start is not None:
+        metrics.observe(
+            'gifmaker_http_request_duration_seconds',
+            time.perf_counter() - start,
+            route=request.url_rule.rule if request.url_rule is not None else 'unmatched',
+            method=request.method,
+            status=str(response.status_code)
+        )
+    return response
 
 
 @app.route('/')
@@ -23,6 +148,82 @@ def index():
     return render_template('index.html')
 
 
+def get_session_id(session_id):
+    # Use the given session, creating it (or a new one) if needed
+    return session_store.ensure(session_id)
+
+
+def url_filename(url):
+    # Generate a safe filename from URL
+    filename = os.path.basename(urlparse(url).path)
+    if not filename or '.' not in filename:
+        filename = f"image_{uuid.uuid4().hex}.jpg"
+    return secure_filename(filename)
+
+
+def make_preview(digest, file_path):
+    # Make the thumbnail and decode the image once, at upload time, and
+    # hand back the thumbnail's URL
+    thumbnail_store.ensure(digest, file_path)
+    raw_store.ensure(digest, file_path)
+    return url_for('thumbnail', digest=digest)
+
+
+def image_options_for(file_path, stride=1, max_frames=None):
+    # Session options for a new image. Animated GIFs, WebPs and PNGs play
+    # as clips, sampled down to max_frames frames.
+    if max_frames is None:
+        max_frames = app.config['CLIP_MAX_FRAMES']
+    clip = clip_options(file_path, stride, max_frames)
+    return {'clip': clip} if clip else {}
+
+
+def clip_sampling(form):
+    # Multi-frame images play every stride-th frame, spaced out further to
+    # keep to max_frames
+    try:
+        stride = int(form.get('stride', 1))
+        max_frames = int(form.get('max_frames', app.config['CLIP_MAX_FRAMES']))
+    except ValueError:
+        raise ValueError('Invalid stride or maximum frames')
+    if stride < 1:
+        raise ValueError('Stride must be 1 or greater')
+    if max_frames < 0:
+        raise ValueError('Maximum frames must be 0 or greater')
+    return stride, max_frames
+
+
+def ingest_upload(stream, stride, max_frames):
+    # Save an upload under the hash of its content, make its thumbnail and
+    # decode it. Runs on the ingest pool, outside of the request.
+    digest, file_path = upload_store.put_stream(stream)
+    thumbnail_store.ensure(digest, file_path)
+    raw_store.ensure(digest, file_path)
+    return digest, file_path, image_options_for(file_path, stride, max_frames)
+
+
+def clip_frames(options):
+    # How many frames an image plays
+    clip = options.get('clip')
+    if not clip:
+        return 1
+    return len(sampled_frames(clip['frames'], clip['stride'], clip['max_frames']))
+
+
+def fetch_and_preview(url):
+    # Stream the image straight into the upload store
+    digest, file_path = fetch_to_store(url, upload_store, max_bytes=app.config['FETCH_MAX_BYTES'])
+    return file_path, make_preview(digest, file_path)
+
+
+def fetch_error_message(e):
+    if isinstance(e, FetchError):
+        return str(e)
+    if isinstance(e, requests.RequestException):
+        return f'Failed to fetch image: {str(e)}'
+    return f'Error processing image: {str(e)}'
+
+
 @app.route('/fetch-image', methods=['POST'])
 def fetch_image():
     if 'url' not in request.json:
@@ -30,70 +231,70 @@ def fetch_image():
     
     url = request.json['url']
     
-    # Validate URL
     try:
-        parsed_url = urlparse(url)
-        if not parsed_url.scheme or not parsed_url.netloc:
-            return jsonify({'status': 'error', 'message': 'Invalid URL format'}), 400
-    except Exception:
-        return jsonify({'status': 'error', 'message': 'Invalid URL format'}), 400
-    
-    try:
-        # Fetch the image
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        
-        # Check if it's an image
-        content_type = response.headers.get('Content-Type', '')
-        if not content_type.startswith('image/'):
-            return jsonify({'status': 'error', 'message': f'URL does not point to an image: {content_type}'}), 400
-        
-        # Generate a filename from URL
-        filename = os.path.basename(urlparse(url).path)
-        if not filename or '.' not in filename:
-            filename = f"image_{uuid.uuid4().hex}.jpg"
-        
-        # Make the filename safe
-        filename = secure_filename(filename)
-        
-        # Generate a session ID if not present
-        session_id = request.json.get('session_id')
-        if not session_id:
-            session_id = uuid.uuid4().hex
-            session_storage[session_id] = {'images': [], 'animations': []}
-        elif session_id not in session_storage:
-            session_storage[session_id] = {'images': [], 'animations': []}
+        file_path, preview_url = fetch_and_preview(url)
         
-        # Save the image
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        with open(file_path, 'wb') as f:
-            f.write(response.content)
-        
-        # Generate a base64 preview for immediate display
-        image = Image.open(io.BytesIO(response.content))
-        # Resize for preview if needed
-        image.thumbnail((400, 400))
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+        session_id = get_session_id(request.json.get('session_id'))
         
         # Add to session storage
-        session_storage[session_id]['images'].append(file_path)
-        session_storage[session_id]['animations'].append("None")
+        options = image_options_for(file_path)
+        index = session_store.append_image(session_id, file_path, options=options)
         
         return jsonify({
             'status': 'success', 
-            'filename': filename,
+            'filename': url_filename(url),
             'path': file_path,
-            'preview': img_str,
+            'preview_url': preview_url,
             'session_id': session_id,
-            'index': len(session_storage[session_id]['images']) - 1
+            'index': index,
+            'frames': clip_frames(options)
         })
         
-    except requests.RequestException as e:
-        return jsonify({'status': 'error', 'message': f'Failed to fetch image: {str(e)}'}), 500
+    except FetchError as e:
+        return jsonify({'status': 'error', 'message': fetch_error_message(e)}), e.status_code
     except Exception as e:
-        return jsonify({'status': 'error', 'message': f'Error processing image: {str(e)}'}), 500
+        return jsonify({'status': 'error', 'message': fetch_error_message(e)}), 500
+
+
+@app.route('/fetch-images', methods=['POST'])
+def fetch_images():
+    urls = request.json.get('urls')
+    if not isinstance(urls, list) or not urls:
+        return jsonify({'status': 'error', 'message': 'No URLs provided'}), 400
+    
+    if len(urls) > app.config['FETCH_BATCH_LIMIT']:
+        return jsonify({'status': 'error', 'message': f"At most {app.config['FETCH_BATCH_LIMIT']} URLs can be fetched at once"}), 400
+    
+    session_id = get_session_id(request.json.get('session_id'))
+    
+    # Fetch in parallel, then add the images to the session in the order given
+    results = fetch_many(fetch_and_preview, urls, concurrency=app.config['FETCH_CONCURRENCY'])
+    
+    images = []
+    for url, (result, error) in zip(urls, results):
+        if error is not None:
+            images.append({'status': 'error', 'url': url, 'message': fetch_error_message(error)})
+            continue
+        
+        file_path, preview_url = result
+        options = image_options_for(file_path)
+        index = session_store.append_image(session_id, file_path, options=options)
+        
+        images.append({
+            'status': 'success',
+            'url': url,
+            'filename': url_filename(url),
+            'path': file_path,
+            'preview_url': preview_url,
+            'index': index,
+            'frames': clip_frames(options)
+        })
+    
+    return jsonify({
+        'status': 'success',
+        'session_id': session_id,
+        'images': images
+    })
 
 
 @app.route('/upload-image', methods=['POST'])
@@ -105,62 +306,106 @@ def upload_image():
     if file.filename == '':
         return jsonify({'status': 'error', 'message': 'No selected file'}), 400
     
+    try:
+        stride, max_frames = clip_sampling(request.form)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
     try:
         # Generate a session ID if not present
-        session_id = request.form.get('session_id')
-        if not session_id:
-            session_id = uuid.uuid4().hex
-            session_storage[session_id] = {'images': [], 'animations': []}
-        elif session_id not in session_storage:
-            session_storage[session_id] = {'images': [], 'animations': []}
+        session_id = get_session_id(request.form.get('session_id'))
         
-        # Save the file
+        # Save the file under the hash of its content
         filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+        digest, file_path = upload_store.put_stream(file.stream)
         
-        # Generate a base64 preview
-        image = Image.open(file_path)
-        # Resize for preview
-        image.thumbnail((400, 400))
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+        # Generate the preview thumbnail
+        preview_url = make_preview(digest, file_path)
         
         # Add to session storage
-        session_storage[session_id]['images'].append(file_path)
-        session_storage[session_id]['animations'].append("None")
+        options = image_options_for(file_path, stride, max_frames)
+        index = session_store.append_image(session_id, file_path, options=options)
         
         return jsonify({
             'status': 'success', 
             'filename': filename,
             'path': file_path,
-            'preview': img_str,
+            'preview_url': preview_url,
             'session_id': session_id,
-            'index': len(session_storage[session_id]['images']) - 1
+            'index': index,
+            'frames': clip_frames(options)
         })
         
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'Error processing image: {str(e)}'}), 500
 
 
+@app.route('/upload-images', methods=['POST'])
+def upload_images():
+    files = [file for file in request.files.getlist('files') if file.filename != '']
+    if not files:
+        return jsonify({'status': 'error', 'message': 'No selected files'}), 400
+    
+    if len(files) > app.config['UPLOAD_BATCH_LIMIT']:
+        return jsonify({'status': 'error', 'message': f"At most {app.config['UPLOAD_BATCH_LIMIT']} files can be uploaded at once"}), 400
+    
+    try:
+        stride, max_frames = clip_sampling(request.form)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
+    session_id = get_session_id(request.form.get('session_id'))
+    
+    def results():
+        # One line of JSON per file, sent as soon as the file is processed,
+        # where position is the file's place in the upload. Files are added
+        # to the session in upload order, so one that finishes early waits
+        # for the files before it and its index is null until then.
+        processed = ingest_pool.process(lambda file: ingest_upload(file.stream, stride, max_frames), files)
+        finished = {}
+        indexes = {}
+        stored = 0
+        for position, result, error in processed:
+            finished[position] = result if error is None else None
+            while stored in finished:
+                ready = finished.pop(stored)
+                if ready is not None:
+                    indexes[stored] = session_store.append_image(session_id, ready[1], options=ready[2])
+                stored += 1
+            
+            filename = secure_filename(files[position].filename)
+            if error is not None:
+                line = {'status': 'error', 'position': position, 'filename': filename,
+                        'message': f'Error processing image: {str(error)}'}
+            else:
+                digest, file_path, options = result
+                line = {
+                    'status': 'success',
+                    'position': position,
+                    'filename': filename,
+                    'path': file_path,
+                    'preview_url': url_for('thumbnail', digest=digest),
+                    'session_id': session_id,
+                    'index': indexes.get(position),
+                    'frames': clip_frames(options)
+                }
+            yield json.dumps(line) + '\n'
+    
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson')
+
+
 @app.route('/remove-image', methods=['POST'])
 def remove_image():
     session_id = request.json.get('session_id')
     index = request.json.get('index')
     
-    if not session_id or session_id not in session_storage:
+    if not session_id or not session_store.exists(session_id):
         return jsonify({'status': 'error', 'message': 'Invalid session'}), 400
     
     try:
-        index = int(index)
-        if index < 0 or index >= len(session_storage[session_id]['images']):
-            return jsonify({'status': 'error', 'message': 'Invalid image index'}), 400
-        
         # Remove the image from session storage
-        del session_storage[session_id]['images'][index]
-        if index < len(session_storage[session_id]['animations']):
-            del session_storage[session_id]['animations'][index]
+        if not session_store.remove_image(session_id, int(index)):
+            return jsonify({'status': 'error', 'message': 'Invalid image index'}), 400
         
         return jsonify({'status': 'success'})
         
@@ -174,16 +419,13 @@ def update_animation():
     index = request.json.get('index')
     animation = request.json.get('animation')
     
-    if not session_id or session_id not in session_storage:
+    if not session_id or not session_store.exists(session_id):
         return jsonify({'status': 'error', 'message': 'Invalid session'}), 400
     
     try:
-        index = int(index)
-        if index < 0 or index >= len(session_storage[session_id]['images']):
-            return jsonify({'status': 'error', 'message': 'Invalid image index'}), 400
-        
         # Update the animation type
-        session_storage[session_id]['animations'][index] = animation
+        if not session_store.set_animation(session_id, int(index), animation):
+            return jsonify({'status': 'error', 'message': 'Invalid image index'}), 400
         
         return jsonify({'status': 'success'})
         
@@ -196,13 +438,12 @@ def update_all_animations():
     session_id = request.json.get('session_id')
     animation = request.json.get('animation')
     
-    if not session_id or session_id not in session_storage:
+    if not session_id or not session_store.exists(session_id):
         return jsonify({'status': 'error', 'message': 'Invalid session'}), 400
     
     try:
         # Update all animation types
-        num_images = len(session_storage[session_id]['images'])
-        session_storage[session_id]['animations'] = [animation] * num_images
+        session_store.set_all_animations(session_id, animation)
         
         return jsonify({'status': 'success'})
         
@@ -210,16 +451,75 @@ def update_all_animations():
         return jsonify({'status': 'error', 'message': f'Error updating animations: {str(e)}'}), 500
 
 
+@app.route('/update-timing', methods=['POST'])
+def update_timing():
+    # How long an image is held and how long its transition takes, in
+    # renders made with a frame rate. null goes back to the render's own.
+    session_id = request.json.get('session_id')
+    index = request.json.get('index')
+    
+    if not session_id or not session_store.exists(session_id):
+        return jsonify({'status': 'error', 'message': 'Invalid session'}), 400
+    
+    try:
+        changes = {}
+        for field in ('hold', 'transition_time'):
+            if field in request.json:
+                value = request.json[field]
+                changes[field] = int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Hold and transition times must be in milliseconds'}), 400
+    
+    if changes.get('hold') is not None and changes['hold'] <= 0:
+        return jsonify({'status': 'error', 'message': 'Hold time must be greater than 0'}), 400
+    
+    if changes.get('transition_time') is not None and changes['transition_time'] < 0:
+        return jsonify({'status': 'error', 'message': 'Transition time must be 0 or greater'}), 400
+    
+    try:
+        if not session_store.update_options(session_id, int(index), changes):
+            return jsonify({'status': 'error', 'message': 'Invalid image index'}), 400
+        
+        return jsonify({'status': 'success'})
+        
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'Error updating timing: {str(e)}'}), 500
+
+
 @app.route('/create-gif', methods=['POST'])
 def create_gif():
     session_id = request.json.get('session_id')
     duration = request.json.get('duration')
     loop = request.json.get('loop')
     transition_frames = request.json.get('transition_frames')
+    fps = request.json.get('fps')
+    stream = bool(request.json.get('stream'))
+    scale_quality = request.json.get('scale_quality') or app.config['SCALE_QUALITY']
+    trace = bool(request.json.get('trace'))
     
-    if not session_id or session_id not in session_storage:
+    session = session_store.get(session_id) if session_id else None
+    if session is None:
         return jsonify({'status': 'error', 'message': 'Invalid session'}), 400
     
+    try:
+        quantizer = Quantizer(
+            mode=request.json.get('palette') or app.config['PALETTE_MODE'],
+            method=request.json.get('quantizer') or app.config['QUANTIZER'],
+            dither=bool(request.json.get('dither'))
+        )
+        normalizer = Normalizer(
+            max_dimension=int(request.json.get('max_size', app.config['MAX_DIMENSION'])),
+            fit=request.json.get('fit') or app.config['FIT_MODE']
+        )
+        output_format = OutputFormat(
+            name=request.json.get('format') or app.config['OUTPUT_FORMAT'],
+            lossless=bool(request.json.get('lossless')),
+            quality=int(request.json.get('quality', 80)),
+            method=int(request.json.get('method', 4))
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
     try:
         duration = int(duration)
         loop = int(loop)
@@ -231,189 +531,336 @@ def create_gif():
         if transition_frames < 0:
             return jsonify({'status': 'error', 'message': 'Transition frames must be 0 or greater'}), 400
         
+        if scale_quality not in SCALE_QUALITIES:
+            return jsonify({'status': 'error', 'message': f'Unknown scale quality: {scale_quality}'}), 400
+        
         # Get the images
-        image_paths = session_storage[session_id]['images']
-        animations = session_storage[session_id]['animations']
+        image_paths = session['images']
+        image_options = session['options']
+        animations = session['animations']
         
         if not image_paths:
             return jsonify({'status': 'error', 'message': 'No images to create GIF'}), 400
         
-        # Load images
-        images = [Image.open(path) for path in image_paths]
-        
-        # Resize all images to the same size (using the size of the first image)
-        base_width, base_height = images[0].size
-        resized_images = []
-        
-        for img in images:
-            if img.size != (base_width, base_height):
-                resized = img.resize((base_width, base_height), Image.LANCZOS)
-                resized_images.append(resized)
-            else:
-                resized_images.append(img.copy())
-        
-        # Create the final frames including transitions
-        final_frames = []
-        
-        for i in range(len(resized_images)):
-            # Add the current frame
-            final_frames.append(resized_images[i])
-            
-            # Add transition to the next frame if it's not the last frame
-            if i < len(resized_images) - 1:
-                # Get animation type for the current image
-                animation_type = animations[i] if i < len(animations) else "None"
-                
-                # Create transition frames
-                transition = create_transition_frames(
-                    resized_images[i], 
-                    resized_images[(i + 1) % len(resized_images)],
-                    animation_type,
-                    transition_frames
-                )
-                
-                # Add transition frames
-                final_frames.extend(transition)
-        
-        # Create a unique filename for the GIF
-        output_filename = f"output_{uuid.uuid4().hex}.gif"
+        # With a frame rate, images are held and transitions last for times
+        # of their own, instead of every frame lasting duration
+        timeline = None
+        if fps:
+            try:
+                timeline = make_timeline(image_paths, image_options, animations, duration, request.json.get('transition_time'), transition_frames, float(fps))
+            except (TypeError, ValueError) as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+        
+        # The same GIF may have been made before, or be in the middle of
+        # being made for another request
+        key, output_filename = output_name(image_paths, image_options, animations, duration, loop, transition_frames, timeline, scale_quality, quantizer, normalizer, output_format)
         output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        
-        # Save as gif
-        final_frames[0].save(
-            output_path,
-            format='GIF',
-            append_images=final_frames[1:],
-            save_all=True,
-            duration=duration,
-            loop=loop,
-            optimize=False
-        )
-        
-        return jsonify({
+        cached = os.path.exists(output_path)
+        if cached and stream:
+            return send_output(output_filename)
+        
+        # Streaming renders send the GIF as it is encoded instead of once
+        # it is done
+        if stream:
+            return stream_gif(output_filename, image_paths, image_options, animations, duration, loop, transition_frames, timeline, scale_quality, quantizer, normalizer, output_format)
+        
+        stages = None
+        if cached:
+            mark_used(output_path)
+        else:
+            stages = render_flights.do(key, lambda: render_gif(
+                output_path, image_paths, image_options, animations, duration, loop, transition_frames, timeline, scale_quality, quantizer, normalizer, output_format
+            ))
+        
+        response = {
             'status': 'success', 
             'filename': output_filename,
-            'path': output_path
-        })
+            'path': output_path,
+            'cached': cached
+        }
+        if trace:
+            # Where the render's time went, empty when nothing was rendered
+            response['stages'] = stages or {}
+        return jsonify(response)
         
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'Error creating GIF: {str(e)}'}), 500
 
 
-def create_transition_frames(prev_img, next_img, transition_type, num_frames):
-    frames = []
+def render_gif(output_path, image_paths, image_options, animations, duration, loop, transition_frames, timeline, scale_quality, quantizer, normalizer, output_format):
+    # Another request may have finished the same GIF while this one waited
+    if os.path.exists(output_path):
+        return None
+
+    start = time.perf_counter()
+    with tracing() as trace:
+        for _ in write_output(output_path, encode_gif(image_paths, image_options, animations, duration, loop, transition_frames, timeline, scale_quality, quantizer, normalizer, output_format)):
+            pass
+    record_render(metrics, trace, time.perf_counter() - start)
+    # Returns how long each stage took
+    return trace.report()
+
+
+def write_output(output_path, chunks):
+    # Pass the chunks through while writing them to the output, moving it
+    # into place only once it is complete so a cache hit never sees half a file
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def stream_gif(output_filename, image_paths, image_options, animations, duration, loop, transition_frames, timeline, scale_quality, quantizer, normalizer, output_format):
+    # Send the GIF as it is encoded. It is still written to the output
+    # folder on the way, so asking for it again finds it there.
+    output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+    trace = Trace()
+    start = time.perf_counter()
+    chunks = traced(trace, write_output(output_path, encode_gif(image_paths, image_options, animations, duration, loop, transition_frames, timeline, scale_quality, quantizer, normalizer, output_format)))
     
-    # Ensure both images are the same size
-    if prev_img.size != next_img.size:
-        next_img = next_img.resize(prev_img.size, Image.LANCZOS)
+    # Wait for the first bytes, so a render that fails straight away still
+    # gets an error response
+    first = next(chunks)
     
-    width, height = prev_img.size
+    def send():
+        yield first
+        yield from chunks
+        record_render(metrics, trace, time.perf_counter() - start)
     
-    # Skip transition if None or Instant is selected, or if num_frames is 0
-    if transition_type == "None" or transition_type == "Instant" or num_frames == 0:
-        return []
+    response = Response(send(), mimetype=output_format.mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={output_filename}'
+    # Stop proxies like nginx from holding the response back until it is complete
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def output_name(image_paths, image_options, animations, duration, loop, transition_frames, timeline, scale_quality, quantizer, normalizer, output_format):
+    # Renders are named after a hash of everything that goes into them, so
+    # asking for the same GIF again finds the one already made
+    key = render_key(
+        image_paths,
+        options=image_options,
+        renderer=RENDERER,
+        animations=animations,
+        duration=duration,
+        loop=loop,
+        transition_frames=transition_frames,
+        scale_quality=scale_quality,
+        palette=quantizer.mode,
+        quantizer=quantizer.method,
+        dither=quantizer.dither,
+        max_size=normalizer.max_dimension,
+        fit=normalizer.fit,
+        **output_format.settings(),
+        **(timeline.settings() if timeline is not None else {})
+    )
+    return key, f"output_{key}{output_format.extension}"
+
+
+def image_digests(image_paths, image_options):
+    # What each image's segments are keyed on: its content, and for a clip
+    # which of its frames are played
+    return [
+        [content_digest(path), options['clip']] if options.get('clip') else content_digest(path)
+        for path, options in zip(image_paths, image_options)
+    ]
+
+
+def load_item(path, options, size, normalizer):
+    # A still image, or a clip that decodes the rest of its frames as it
+    # plays
+    img = load_frame(path, size, normalizer)
+    clip = options.get('clip')
+    if not clip:
+        return img
+    return Clip(path, size, img, clip['frames'], clip['stride'], clip['max_frames'], normalizer)
+
+
+def load_frame(path, size, normalizer):
+    # Fitted images are cached per worker, and made from the upload's raw
+    # pixels rather than by decoding it again. Upload paths are named after
+    # the file's content, so the path, size and fit are enough of a key.
+    return image_cache.get_or_load(
+        (path, size, normalizer.fit),
+        lambda: raw_store.load(content_digest(path), path, size, normalizer)
+    )
+
+
+def encode_gif(image_paths, image_options, animations, duration, loop, transition_frames, timeline, scale_quality, quantizer, normalizer, output_format):
+    # The output's bytes, in order. For a GIF, segments encoded by earlier
+    # renders are spliced back in as they are, only the ones whose images,
+    # transitions or neighbours changed are rendered again. WebP and APNG
+    # are rendered in full color and encoded from start to end.
+    transitions = get_transitions(image_paths, animations)
+    frame_counts = transition_frames
+    durations = None
+    if timeline is not None:
+        # Each transition gets the frames its time needs at the frame rate
+        frame_counts = timeline.transition_frames()
+        durations = frame_durations(image_paths, transitions, frame_counts, timeline, normalizer)
     
-    if transition_type == "Fade in":
-        # Create a series of images that gradually fade from prev to next
-        for i in range(num_frames):
-            alpha = i / num_frames
-            frame = Image.blend(prev_img.convert("RGBA"), next_img.convert("RGBA"), alpha)
-            frames.append(frame.convert("RGB") if frame.mode == "RGBA" else frame)
-            
-    elif transition_type == "Slide up":
-        # Next image slides up from the bottom
-        for i in range(num_frames):
-            frame = Image.new("RGB", prev_img.size, (255, 255, 255))
-            offset = int(height * (1 - i/num_frames))
-            # Put the previous image fully visible
-            frame.paste(prev_img, (0, 0))
-            # Slide the next image up from the bottom
-            visible_part = next_img.crop((0, 0, width, height - offset))
-            frame.paste(visible_part, (0, offset))
-            frames.append(frame)
-    
-    elif transition_type == "Slide down":
-        # Next image slides down from the top
-        for i in range(num_frames):
-            frame = Image.new("RGB", prev_img.size, (255, 255, 255))
-            offset = int(height * (i/num_frames))
-            # Put the previous image fully visible
-            frame.paste(prev_img, (0, 0))
-            # Slide the next image down from the top
-            visible_part = next_img.crop((0, offset, width, height))
-            frame.paste(visible_part, (0, 0))
-            frames.append(frame)
-    
-    elif transition_type == "Slide right":
-        # Next image slides from the left
-        for i in range(num_frames):
-            frame = Image.new("RGB", prev_img.size, (255, 255, 255))
-            offset = int(width * (1 - i/num_frames))
-            # Put the previous image fully visible
-            frame.paste(prev_img, (0, 0))
-            # Slide the next image from the left
-            visible_part = next_img.crop((0, 0, width - offset, height))
-            frame.paste(visible_part, (offset, 0))
-            frames.append(frame)
-    
-    elif transition_type == "Slide left":
-        # Next image slides from the right
-        for i in range(num_frames):
-            frame = Image.new("RGB", prev_img.size, (255, 255, 255))
-            offset = int(width * (i/num_frames))
-            # Put the previous image fully visible
-            frame.paste(prev_img, (0, 0))
-            # Slide the next image from the right
-            visible_part = next_img.crop((offset, 0, width, height))
-            frame.paste(visible_part, (0, 0))
-            frames.append(frame)
-    
-    elif transition_type == "Grow":
-        # Next image grows from center
-        for i in range(num_frames):
-            frame = Image.new("RGB", prev_img.size, (255, 255, 255))
-            scale = i / num_frames
-            # Start with previous image
-            frame.paste(prev_img, (0, 0))
-            # Calculate the size and position of the growing image
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            left = (width - new_width) // 2
-            top = (height - new_height) // 2
-            
-            if new_width > 0 and new_height > 0:
-                growing_img = next_img.resize((new_width, new_height), Image.LANCZOS)
-                frame.paste(growing_img, (left, top))
-            
-            frames.append(frame)
+    if not output_format.quantized:
+        return AnimationStream(
+            generate_segments(image_paths, image_options, transitions, frame_counts, scale_quality, quantizer, normalizer, rgb=True),
+            output_format,
+            duration=duration,
+            loop=loop,
+            durations=durations
+        )
     
-    elif transition_type == "Shrink":
-        # Previous image shrinks to center
-        for i in range(num_frames):
-            scale = 1 - (i / num_frames)
-            
-            # Create a blank frame with next image
-            frame = Image.new("RGB", next_img.size, (255, 255, 255))
-            frame.paste(next_img, (0, 0))
-            
-            # Calculate the size and position of the shrinking image
-            new_width = max(1, int(width * scale))
-            new_height = max(1, int(height * scale))
-            left = (width - new_width) // 2
-            top = (height - new_height) // 2
-            
-            if new_width > 0 and new_height > 0:
-                shrinking_img = prev_img.resize((new_width, new_height), Image.LANCZOS)
-                frame.paste(shrinking_img, (left, top))
-            
-            frames.append(frame)
-            
-    return frames
+    keys = segment_keys(
+        image_digests(image_paths, image_options),
+        transitions,
+        transition_frames,
+        quantizer.mode,
+        durations=durations,
+        renderer=RENDERER,
+        duration=duration,
+        loop=loop,
+        scale_quality=scale_quality,
+        quantizer=quantizer.method,
+        dither=quantizer.dither,
+        max_size=normalizer.max_dimension,
+        fit=normalizer.fit
+    )
+    skip = {i for i, key in enumerate(keys) if segment_cache.has(key)}
+    
+    return SegmentStream(
+        generate_segments(image_paths, image_options, transitions, frame_counts, scale_quality, quantizer, normalizer, skip),
+        keys,
+        segment_cache,
+        duration=duration,
+        loop=loop,
+        durations=durations
+    )
+
+
+def frame_durations(image_paths, transitions, transition_frames, timeline, normalizer):
+    # The timeline's frame durations of every segment, with each transition's
+    # time spread over the frames it is actually rendered with
+    size = canvas_size(image_paths, normalizer)
+    return [
+        timeline.segment_durations(i, transition_frame_count(size, transitions[i], transition_frames[i], overlay=True) if i < len(transitions) else None)
+        for i in range(len(image_paths))
+    ]
+
+
+def make_timeline(image_paths, image_options, animations, hold, transition_time, transition_frames, fps):
+    # Each image's own hold and transition time, or the render's. Like its
+    # animation, an image's transition time is for the transition out of it.
+    if transition_time is None:
+        # As long as transitions took when every frame lasted hold
+        transition_time = transition_frames * hold
+    holds = [options.get('hold', hold) for options in image_options]
+    # Pairs with no transition go straight from one image to the next
+    times = [
+        int(options.get('transition_time', transition_time)) if transition in TRANSITION_TYPES else 0
+        for options, transition in zip(image_options[:-1], get_transitions(image_paths, animations))
+    ]
+    return Timeline(holds, times, fps, [clip_frames(options) for options in image_options])
+
+
+def get_transitions(image_paths, animations):
+    # Each image's animation is the transition out of it
+    return [
+        animations[i] if i < len(animations) else "None"
+        for i in range(len(image_paths) - 1)
+    ]
+
+
+def canvas_size(image_paths, normalizer):
+    # Every image is fitted to a canvas the shape of the first one
+    return normalizer.canvas_size(raw_store.source_size(content_digest(image_paths[0]), image_paths[0]))
+
+
+def generate_segments(image_paths, image_options, transitions, transition_frames, scale_quality, quantizer, normalizer, skip=(), rgb=False):
+    # Yield each image (or every frame of a clip) with its transition into
+    # the next one, quantized unless rgb is set, as (index, frames).
+    # Segments in skip come out without frames. Images are loaded one at a
+    # time as the renderer needs them, so long sequences don't pile up
+    # frames, and images only skipped segments use aren't loaded at all.
+    base_size = canvas_size(image_paths, normalizer)
+    
+    # A global palette is built up front from small copies of every image
+    if not rgb and len(skip) < len(image_paths):
+        with span('palette'):
+            quantizer.use_global_palette(raw_store.open(content_digest(path), path) for path in image_paths)
+    
+    images = (
+        load_item(path, options, base_size, normalizer) if i not in skip or (i > 0 and i - 1 not in skip) else None
+        for i, (path, options) in enumerate(zip(image_paths, image_options))
+    )
+    
+    # The next image is drawn over the current one
+    return iter_segments(
+        images,
+        transitions,
+        transition_frames,
+        overlay=True,
+        processes=app.config['RENDER_PROCESSES'],
+        quantizer=quantizer,
+        skip=skip,
+        rgb=rgb,
+        scale_quality=scale_quality
+    )
+
+
+@app.route('/thumb/<digest>')
+def thumbnail(digest):
+    # Thumbnails are named after the upload's content hash, so a given URL
+    # always serves the same bytes and browsers can cache it for good
+    if len(digest) != 64 or any(c not in '0123456789abcdef' for c in digest):
+        abort(404)
+    
+    path = thumbnail_store.path_for(digest)
+    if not os.path.exists(path):
+        abort(404)
+    
+    response = send_file(os.path.abspath(path), mimetype='image/jpeg', etag=digest, max_age=THUMBNAIL_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def send_output(filename):
+    # Outputs are named after a hash of everything that went into them, so
+    # a file never changes once written. Clients can keep it for good,
+    # revalidate it with If-None-Match and fetch parts of it with Range.
+    filename = secure_filename(filename)
+    mark_used(os.path.join(app.config['OUTPUT_FOLDER'], filename))
+    response = send_from_directory(
+        os.path.abspath(app.config['OUTPUT_FOLDER']),
+        filename,
+        as_attachment=True,
+        etag=os.path.splitext(filename)[0],
+        max_age=OUTPUT_MAX_AGE,
+        conditional=True
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route('/download/<filename>')
 def download_file(filename):
-    return send_from_directory(app.config['OUTPUT_FOLDER'], filename, as_attachment=True)
+    return send_output(filename)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/storage-stats')
+def storage_stats():
+    # Janitor totals since this worker started, and what is stored right now
+    return jsonify({'status': 'success', 'storage': janitor.report()})
 
 
 # if __name__ == '__main__':
@@ -1,5 +1,4 @@
 import os
-import io
 import threading
 import customtkinter as ctk
 from PIL import Image, ImageTk, ImageChops, ImageOps
@@ -8,6 +7,14 @@ from tkinter import filedialog, messagebox
 from urllib.parse import urlparse
 import math
 
+from gifcore.clips import DEFAULT_MAX_FRAMES, Clip, clip_options, first_frame
+from gifcore.fetch import FetchError, fetch_to_file
+from gifcore.formats import OUTPUT_FORMATS, OutputFormat, save_animation
+from gifcore.normalize import FIT_MODES, Normalizer
+from gifcore.previews import load_thumbnail
+from gifcore.store import load_image
+from gifcore.transitions import DEFAULT_SCALE_QUALITY, SCALE_QUALITIES, iter_transition_frames
+
 class GifMakerApp:
     def __init__(self, root):
         self.root = root
@@ -23,6 +30,8 @@ class GifMakerApp:
         self.images = []
         self.image_paths = []
         self.image_animations = []  # Store animation type for each image
+        self.image_clips = []  # How to play each animated image, None for stills
+        self.preview_photos = []  # Cached preview for each image, made on first view
         self.preview_image = None
         self.current_preview_index = 0
         
@@ -165,6 +174,71 @@ class GifMakerApp:
         self.frames_entry.pack(fill="x", pady=5)
         self.frames_entry.insert(0, "10")
         
+        # Image size
+        self.max_size_label = ctk.CTkLabel(self.settings_frame, text="Max Size (px, 0 = original):")
+        self.max_size_label.pack(anchor="w", pady=(5, 0))
+        
+        self.max_size_entry = ctk.CTkEntry(self.settings_frame)
+        self.max_size_entry.pack(fill="x", pady=5)
+        self.max_size_entry.insert(0, "1024")
+        
+        self.fit_label = ctk.CTkLabel(self.settings_frame, text="Fit:")
+        self.fit_label.pack(anchor="w", pady=(5, 0))
+        
+        self.fit_var = ctk.StringVar(value=FIT_MODES[0])
+        self.fit_dropdown = ctk.CTkOptionMenu(
+            self.settings_frame,
+            values=list(FIT_MODES),
+            variable=self.fit_var
+        )
+        self.fit_dropdown.pack(fill="x", pady=5)
+        
+        # How Grow and Shrink resize images, exact being the slowest
+        self.scale_quality_label = ctk.CTkLabel(self.settings_frame, text="Grow/Shrink Quality:")
+        self.scale_quality_label.pack(anchor="w", pady=(5, 0))
+        
+        self.scale_quality_var = ctk.StringVar(value=DEFAULT_SCALE_QUALITY)
+        self.scale_quality_dropdown = ctk.CTkOptionMenu(
+            self.settings_frame,
+            values=list(SCALE_QUALITIES),
+            variable=self.scale_quality_var
+        )
+        self.scale_quality_dropdown.pack(fill="x", pady=5)
+        
+        # How animated images are sampled when they are added
+        self.stride_label = ctk.CTkLabel(self.settings_frame, text="Animated Images: Every Nth Frame:")
+        self.stride_label.pack(anchor="w", pady=(5, 0))
+        
+        self.stride_entry = ctk.CTkEntry(self.settings_frame)
+        self.stride_entry.pack(fill="x", pady=5)
+        self.stride_entry.insert(0, "1")
+        
+        self.max_frames_label = ctk.CTkLabel(self.settings_frame, text="Max Frames per Clip (0 = all):")
+        self.max_frames_label.pack(anchor="w", pady=(5, 0))
+        
+        self.max_frames_entry = ctk.CTkEntry(self.settings_frame)
+        self.max_frames_entry.pack(fill="x", pady=5)
+        self.max_frames_entry.insert(0, str(DEFAULT_MAX_FRAMES))
+        
+        # What the animation is saved as
+        self.format_label = ctk.CTkLabel(self.settings_frame, text="Output Format:")
+        self.format_label.pack(anchor="w", pady=(5, 0))
+        
+        self.format_var = ctk.StringVar(value="gif")
+        self.format_dropdown = ctk.CTkOptionMenu(
+            self.settings_frame,
+            values=list(OUTPUT_FORMATS),
+            variable=self.format_var
+        )
+        self.format_dropdown.pack(fill="x", pady=5)
+        
+        self.quality_label = ctk.CTkLabel(self.settings_frame, text="WebP Quality (0-100):")
+        self.quality_label.pack(anchor="w", pady=(5, 0))
+        
+        self.quality_entry = ctk.CTkEntry(self.settings_frame)
+        self.quality_entry.pack(fill="x", pady=5)
+        self.quality_entry.insert(0, "80")
+        
         # Create GIF button
         self.create_gif_button = ctk.CTkButton(
             self.controls_frame, 
@@ -317,16 +391,6 @@ class GifMakerApp:
     
     def _fetch_image_thread(self, url):
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            
-            # Check if it's an image
-            content_type = response.headers.get('Content-Type', '')
-            if not content_type.startswith('image/'):
-                self.root.after(0, lambda: messagebox.showerror("Error", f"URL does not point to an image: {content_type}"))
-                self.root.after(0, lambda: self.status_label.configure(text="Status: Error fetching image"))
-                return
-            
             # Generate a filename from URL
             filename = os.path.basename(urlparse(url).path)
             if not filename or '.' not in filename:
@@ -338,23 +402,24 @@ class GifMakerApp:
             
             full_path = os.path.join(save_dir, filename)
             
-            # Save the image
-            with open(full_path, 'wb') as f:
-                f.write(response.content)
+            # Stream the image to disk, checking it's an image of a sane size first
+            fetch_to_file(url, full_path)
             
-            # Add to our list
-            image = Image.open(io.BytesIO(response.content))
+            # Decode once, upright and as RGB, and add to our list
+            image = load_image(full_path)
             
             self.root.after(0, lambda: self._add_image(image, full_path))
             self.root.after(0, lambda: self.status_label.configure(text=f"Status: Image saved to {filename}"))
             
-        except requests.RequestException as e:
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to fetch image: {str(e)}"))
+        except (FetchError, requests.RequestException) as e:
+            # Format now, e is cleared once the except block ends
+            message = str(e) if isinstance(e, FetchError) else f"Failed to fetch image: {str(e)}"
+            self.root.after(0, lambda: messagebox.showerror("Error", message))
             self.root.after(0, lambda: self.status_label.configure(text="Status: Error fetching image"))
     
     def browse_files(self):
         filetypes = (
-            ('Image files', '*.png *.jpg *.jpeg *.gif *.bmp *.tiff'),
+            ('Image files', '*.png *.apng *.jpg *.jpeg *.gif *.webp *.bmp *.tiff'),
             ('All files', '*.*')
         )
         
@@ -367,16 +432,29 @@ class GifMakerApp:
         if not filenames:
             return
         
+        try:
+            stride = int(self.stride_entry.get())
+            max_frames = int(self.max_frames_entry.get())
+        except ValueError:
+            messagebox.showerror("Error", "Invalid frame stride or max frames")
+            return
+        
         for filename in filenames:
             try:
-                image = Image.open(filename)
-                self._add_image(image, filename)
+                # Decode once, upright and as RGB, without keeping the file
+                # open. Animated images keep only their first frame in memory
+                # and are read frame by frame when the GIF is made.
+                clip = clip_options(filename, stride, max_frames)
+                image = load_image(filename)
+                self._add_image(image, filename, clip)
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to open {os.path.basename(filename)}: {str(e)}")
     
-    def _add_image(self, image, path):
+    def _add_image(self, image, path, clip=None):
         self.images.append(image)
         self.image_paths.append(path)
+        self.image_clips.append(clip)
+        self.preview_photos.append(None)
         self.image_animations.append("None")  # Default animation
         
         # Update the image list display
@@ -393,15 +471,12 @@ class GifMakerApp:
             self.image_counter.configure(text="0/0")
             return
         
-        # Get the current image
-        image = self.images[self.current_preview_index]
-        
-        # Resize for preview if needed
-        max_size = (400, 400)
-        image = self.resize_image_for_preview(image, max_size)
-        
-        # Convert to PhotoImage
-        photo = ImageTk.PhotoImage(image)
+        # Previews are made once per image, so flipping between images
+        # doesn't resize anything
+        photo = self.preview_photos[self.current_preview_index]
+        if photo is None:
+            photo = self.make_preview(self.current_preview_index)
+            self.preview_photos[self.current_preview_index] = photo
         
         # Store reference to prevent garbage collection
         self.preview_image = photo
@@ -417,16 +492,18 @@ class GifMakerApp:
         if self.current_preview_index < len(self.image_animations):
             self.animation_var.set(self.image_animations[self.current_preview_index])
     
-    def resize_image_for_preview(self, image, max_size):
-        width, height = image.size
-        
-        # Calculate the new size
-        if width > max_size[0] or height > max_size[1]:
-            ratio = min(max_size[0] / width, max_size[1] / height)
-            new_size = (int(width * ratio), int(height * ratio))
-            return image.resize(new_size, Image.LANCZOS)
+    def make_preview(self, index):
+        path = self.image_paths[index]
+        try:
+            # Decode the file straight at preview size
+            image = load_thumbnail(path)
+        except Exception:
+            # Fall back to the image we already have in memory
+            image = self.images[index].copy()
+            image.thumbnail((400, 400), Image.LANCZOS)
         
-        return image
+        # Convert to PhotoImage
+        return ImageTk.PhotoImage(image)
     
     def show_next_image(self):
         if not self.images:
@@ -449,6 +526,8 @@ class GifMakerApp:
         # Remove the image and its animation
         del self.images[self.current_preview_index]
         del self.image_paths[self.current_preview_index]
+        del self.image_clips[self.current_preview_index]
+        del self.preview_photos[self.current_preview_index]
         
         if self.current_preview_index < len(self.image_animations):
             del self.image_animations[self.current_preview_index]
@@ -487,6 +566,8 @@ class GifMakerApp:
             duration = int(self.duration_entry.get())
             loop = int(self.loop_entry.get())
             transition_frames = int(self.frames_entry.get())
+            max_size = int(self.max_size_entry.get())
+            output_format = OutputFormat(self.format_var.get(), quality=int(self.quality_entry.get()))
             
             if duration <= 0:
                 messagebox.showerror("Error", "Duration must be greater than 0")
@@ -495,187 +576,83 @@ class GifMakerApp:
             if transition_frames < 0:
                 messagebox.showerror("Error", "Transition frames must be 0 or greater")
                 return
+            
+            if max_size < 0:
+                messagebox.showerror("Error", "Max size must be 0 or greater")
+                return
                 
-        except ValueError:
-            messagebox.showerror("Error", "Invalid duration, loop count, or transition frames")
+        except ValueError as e:
+            messagebox.showerror("Error", f"Invalid duration, loop count, transition frames, max size or quality: {e}")
             return
         
         # Ask user for save location
         save_path = filedialog.asksaveasfilename(
-            title='Save GIF',
-            defaultextension='.gif',
-            filetypes=[('GIF files', '*.gif')],
+            title='Save Animation',
+            defaultextension=output_format.extension,
+            filetypes=[(f'{output_format.name.upper()} files', f'*{output_format.extension}')],
             initialdir=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gif_maker", "output")
         )
         
         if not save_path:
             return
         
+        normalizer = Normalizer(max_size, self.fit_var.get())
         self.status_label.configure(text="Status: Creating GIF...")
         
         # Run in a thread to avoid freezing UI
         threading.Thread(
             target=self._create_gif_thread, 
-            args=(save_path, duration, loop, transition_frames), 
+            args=(save_path, duration, loop, transition_frames, self.scale_quality_var.get(), normalizer, output_format), 
             daemon=True
         ).start()
     
-    def create_transition_frames(self, prev_img, next_img, transition_type, num_frames):
-        frames = []
-        
-        # Ensure both images are the same size
-        if prev_img.size != next_img.size:
-            next_img = next_img.resize(prev_img.size, Image.LANCZOS)
-        
-        width, height = prev_img.size
-        
+    def create_transition_frames(self, prev_img, next_img, transition_type, num_frames, scale_quality=DEFAULT_SCALE_QUALITY):
         # Skip transition if None or Instant is selected, or if num_frames is 0
         if transition_type == "None" or transition_type == "Instant" or num_frames == 0:
             return []
         
-        if transition_type == "Fade in":
-            # Create a series of images that gradually fade from prev to next
-            for i in range(num_frames):
-                alpha = i / num_frames
-                frame = Image.blend(prev_img.convert("RGBA"), next_img.convert("RGBA"), alpha)
-                frames.append(frame.convert("RGB") if frame.mode == "RGBA" else frame)
-                
-        elif transition_type == "Slide up":
-            # Next image slides up from the bottom
-            for i in range(num_frames):
-                frame = Image.new("RGB", prev_img.size, (255, 255, 255))
-                offset = int(height * (1 - i/num_frames))
-                # Put the previous image fully visible
-                frame.paste(prev_img, (0, 0))
-                # Slide the next image up from the bottom
-                visible_part = next_img.crop((0, 0, width, height - offset))
-                frame.paste(visible_part, (0, offset))
-                frames.append(frame)
-        
-        elif transition_type == "Slide down":
-            # Next image slides down from the top
-            for i in range(num_frames):
-                frame = Image.new("RGB", prev_img.size, (255, 255, 255))
-                offset = int(height * (i/num_frames))
-                # Put the previous image fully visible
-                frame.paste(prev_img, (0, 0))
-                # Slide the next image down from the top
-                visible_part = next_img.crop((0, offset, width, height))
-                frame.paste(visible_part, (0, 0))
-                frames.append(frame)
-        
-        elif transition_type == "Slide right":
-            # Next image slides from the left
-            for i in range(num_frames):
-                frame = Image.new("RGB", prev_img.size, (255, 255, 255))
-                offset = int(width * (1 - i/num_frames))
-                # Put the previous image fully visible
-                frame.paste(prev_img, (0, 0))
-                # Slide the next image from the left
-                visible_part = next_img.crop((0, 0, width - offset, height))
-                frame.paste(visible_part, (offset, 0))
-                frames.append(frame)
-        
-        elif transition_type == "Slide left":
-            # Next image slides from the right
-            for i in range(num_frames):
-                frame = Image.new("RGB", prev_img.size, (255, 255, 255))
-                offset = int(width * (i/num_frames))
-                # Put the previous image fully visible
-                frame.paste(prev_img, (0, 0))
-                # Slide the next image from the right
-                visible_part = next_img.crop((offset, 0, width, height))
-                frame.paste(visible_part, (0, 0))
-                frames.append(frame)
-        
-        elif transition_type == "Grow":
-            # Next image grows from center
-            for i in range(num_frames):
-                frame = Image.new("RGB", prev_img.size, (255, 255, 255))
-                scale = i / num_frames
-                # Start with previous image
-                frame.paste(prev_img, (0, 0))
-                # Calculate the size and position of the growing image
-                new_width = int(width * scale)
-                new_height = int(height * scale)
-                left = (width - new_width) // 2
-                top = (height - new_height) // 2
-                
-                if new_width > 0 and new_height > 0:
-                    growing_img = next_img.resize((new_width, new_height), Image.LANCZOS)
-                    frame.paste(growing_img, (left, top))
-                
-                frames.append(frame)
-        
-        elif transition_type == "Shrink":
-            # Previous image shrinks to center
-            for i in range(num_frames):
-                scale = 1 - (i / num_frames)
-                
-                # Create a blank frame with next image
-                frame = Image.new("RGB", next_img.size, (255, 255, 255))
-                frame.paste(next_img, (0, 0))
-                
-                # Calculate the size and position of the shrinking image
-                new_width = max(1, int(width * scale))
-                new_height = max(1, int(height * scale))
-                left = (width - new_width) // 2
-                top = (height - new_height) // 2
-                
-                if new_width > 0 and new_height > 0:
-                    shrinking_img = prev_img.resize((new_width, new_height), Image.LANCZOS)
-                    frame.paste(shrinking_img, (left, top))
-                
-                frames.append(frame)
-                
-        return frames
+        # The next image is drawn over the previous one
+        return list(iter_transition_frames(prev_img, next_img, transition_type, num_frames, overlay=True, scale_quality=scale_quality))
     
-    def _create_gif_thread(self, save_path, duration, loop, transition_frames):
+    def _create_gif_thread(self, save_path, duration, loop, transition_frames, scale_quality, normalizer, output_format):
         try:
-            # Resize all images to the same size (using the size of the first image)
-            base_width, base_height = self.images[0].size
-            resized_images = []
-            
-            for img in self.images:
-                if img.size != (base_width, base_height):
-                    resized = img.resize((base_width, base_height), Image.LANCZOS)
-                    resized_images.append(resized)
-                else:
-                    resized_images.append(img.copy())
+            # Fit all images to the same canvas (the size of the first image,
+            # capped at the max size)
+            canvas = normalizer.canvas_size(self.images[0].size)
+            items = []
+            for img, path, clip in zip(self.images, self.image_paths, self.image_clips):
+                img = normalizer.normalize(img, canvas)
+                if clip is not None:
+                    img = Clip(path, canvas, img, clip['frames'], clip['stride'], clip['max_frames'], normalizer)
+                items.append(img)
+            animations = list(self.image_animations)
             
-            # Create the final frames including transitions
-            final_frames = []
-            
-            for i in range(len(resized_images)):
-                # Add the current frame
-                final_frames.append(resized_images[i])
-                
-                # Add transition to the next frame if it's not the last frame
-                if i < len(resized_images) - 1:
-                    # Get animation type for the current image
-                    animation_type = self.image_animations[i] if i < len(self.image_animations) else "None"
-                    
-                    # Create transition frames
-                    transition = self.create_transition_frames(
-                        resized_images[i], 
-                        resized_images[(i + 1) % len(resized_images)],
-                        animation_type,
-                        transition_frames
-                    )
+            def final_frames():
+                # Every frame including transitions, made as they are written
+                # so long clips never sit in memory all at once
+                for i, item in enumerate(items):
+                    # The image, or each frame of a clip
+                    last = None
+                    for last in (item if isinstance(item, Clip) else [item]):
+                        yield last
                     
-                    # Add transition frames
-                    final_frames.extend(transition)
+                    # Add transition to the next frame if it's not the last frame
+                    if i < len(items) - 1:
+                        # Get animation type for the current image
+                        animation_type = animations[i] if i < len(animations) else "None"
+                        
+                        # Transitions run out of a clip's last frame
+                        yield from self.create_transition_frames(
+                            last,
+                            first_frame(items[i + 1]),
+                            animation_type,
+                            transition_frames,
+                            scale_quality
+                        )
             
-            # Save as gif
-            final_frames[0].save(
-                save_path,
-                format='GIF',
-                append_images=final_frames[1:],
-                save_all=True,
-                duration=duration,
-                loop=loop,
-                optimize=False
-            )
+            # Save in the chosen format, writing only what changes from frame
+            # to frame
+            save_animation(save_path, final_frames(), output_format, duration=duration, loop=loop)
             
             self.root.after(0, lambda: self.status_label.configure(text=f"Status: GIF saved to {os.path.basename(save_path)}"))
             self.root.after(0, lambda: messagebox.showinfo("Success", f"GIF created successfully: {save_path}"))
@@ -0,0 +1 @@
+# This file makes the gifcore directory a Python package
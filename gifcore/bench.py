@@ -0,0 +1,297 @@
+# Benchmarks for the render pipeline, run from the repository root with
+#
+#   python -m gifcore.bench [--sizes 640x480,1280x720] [--counts 4]
+#                           [--output results.json] [--baseline baseline.json]
+#
+# Synthetic image sets are made for every size and count, then each stage of
+# a render is timed on its own: resizing the images, every transition type
+# for both renderers (Grow and Shrink at every scale quality), quantizing in
+# every palette mode and encoding, as a GIF and in the full color formats.
+# Every case reports frames per second, peak RSS and, for encoding, the size
+# of the file.
+# With --baseline the results are compared with an earlier --output file and
+# the run fails if a case got slower, bigger or hungrier than the threshold.
+# Everything runs offline on the CPU.
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import PIL
+from PIL import Image
+
+from gifcore.formats import OutputFormat
+from gifcore.normalize import Normalizer
+from gifcore.quantize import PALETTE_MODES, Quantizer
+from gifcore.transitions import DEFAULT_SCALE_QUALITY, SCALE_QUALITIES, TRANSITION_TYPES, iter_transition_frames
+
+DEFAULT_SIZES = "320x240,640x480,1280x720"
+DEFAULT_COUNTS = "4"
+
+# Differences in peak RSS smaller than this are noise
+RSS_SLACK = 8 * 1024 * 1024
+
+# Fast cases are run again until they have taken at least this long, so
+# their best time isn't just timer noise
+MIN_SECONDS = 0.5
+
+
+def synthetic_image(seed, size):
+    # A photo-like image: smooth gradients, some hard edged shapes and a
+    # little noise, so quantizing and encoding have realistic work to do
+    width, height = size
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width] / max(width, height)
+
+    channels = [
+        np.sin(x * rng.uniform(2, 9) + rng.uniform(0, 6)) * 0.35
+        + np.cos(y * rng.uniform(2, 9) + rng.uniform(0, 6)) * 0.35 + 0.5
+        for _ in range(3)
+    ]
+    pixels = np.stack(channels, axis=-1) * 255
+
+    for _ in range(8):
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        x1, y1 = x0 + rng.integers(width // 10, width // 3), y0 + rng.integers(height // 10, height // 3)
+        pixels[y0:y1, x0:x1] = rng.integers(0, 256, 3)
+
+    pixels += rng.normal(0, 4, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def _reset_peak_rss():
+    # Linux lets a process reset its own high water mark, so each case gets
+    # its own peak. Elsewhere the peak only ever grows.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    # Peak resident memory in bytes
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure(fn, repeat):
+    # Run fn repeat times (or more, for fast cases) and keep the fastest
+    # run. fn returns the number of frames it produced and anything else
+    # worth reporting.
+    best = None
+    runs = 0
+    total = 0.0
+    while runs < repeat or total < MIN_SECONDS:
+        _reset_peak_rss()
+        start = time.perf_counter()
+        frames, extra = fn()
+        seconds = time.perf_counter() - start
+        peak_rss = _peak_rss()
+        runs += 1
+        total += seconds
+        if best is None or seconds < best['seconds']:
+            best = {'seconds': seconds, 'frames': frames, 'peak_rss': peak_rss, **extra}
+    best['fps'] = best['frames'] / best['seconds'] if best['seconds'] > 0 else 0.0
+    return best
+
+
+def _segments(images, transitions, num_frames, overlay, scale_quality=DEFAULT_SCALE_QUALITY):
+    # The frames of a GIF of images, as one list per image holding it and
+    # its transition into the next one, cycling through the transitions
+    segments = []
+    for i, img in enumerate(images):
+        frames = [img]
+        if i + 1 < len(images):
+            transition = transitions[i % len(transitions)]
+            frames.extend(iter_transition_frames(img, images[i + 1], transition, num_frames, overlay=overlay,
+                                                 scale_quality=scale_quality))
+        segments.append(frames)
+    return segments
+
+
+def _quantize(segments, images, mode):
+    # Quantize the frames the way a render does in the given palette mode
+    quantizer = Quantizer(mode)
+    quantizer.use_global_palette(images)
+    quantized = []
+    for i, frames in enumerate(segments):
+        palette = quantizer.segment_palette(images[i], images[i + 1] if i + 1 < len(images) else None)
+        quantized.extend(quantizer.quantize(frame, palette) for frame in frames)
+    return quantized
+
+
+# Full color formats encoded alongside the GIF, from the unquantized frames
+FULL_COLOR_CASES = (
+    ("webp", OutputFormat('webp')),
+    ("webp-lossless", OutputFormat('webp', lossless=True)),
+    ("apng", OutputFormat('apng')),
+)
+
+
+def _encode(frames, duration, output_format=None):
+    buffer = io.BytesIO()
+    if output_format is None:
+        output_format = OutputFormat()
+    with output_format.writer(buffer, duration=duration) as writer:
+        for frame in frames:
+            writer.write(frame)
+    return writer.frame_count, {'bytes': len(buffer.getvalue())}
+
+
+def _bench_set(record, prefix, size, count, num_frames, duration):
+    width, height = size
+    images = [synthetic_image(seed, size) for seed in range(count)]
+
+    # Images are fitted to the canvas when loaded. Make the sources a
+    # different shape so the letterboxing is timed too.
+    normalizer = Normalizer()
+    sources = [synthetic_image(seed, (width * 2, height * 3 // 2)) for seed in range(count)]
+    record(f"{prefix}/resize", lambda: (len([normalizer.normalize(src, size) for src in sources]), {}))
+    sources = None
+
+    for renderer, overlay in (("push", False), ("overlay", True)):
+        for transition in TRANSITION_TYPES:
+            record(f"{prefix}/transition/{transition}/{renderer}", lambda: (
+                sum(len(frames) for frames in _segments(images, [transition], num_frames, overlay)), {}
+            ))
+
+        # The default scale quality is timed above, the others are only
+        # different for Grow and Shrink
+        for transition in ("Grow", "Shrink"):
+            for quality in SCALE_QUALITIES:
+                if quality == DEFAULT_SCALE_QUALITY:
+                    continue
+                record(f"{prefix}/transition/{transition}/{renderer}/{quality}", lambda: (
+                    sum(len(frames) for frames in _segments(images, [transition], num_frames, overlay, quality)), {}
+                ))
+
+    segments = _segments(images, TRANSITION_TYPES, num_frames, False)
+    for mode in PALETTE_MODES:
+        record(f"{prefix}/quantize/{mode}", lambda: (len(_quantize(segments, images, mode)), {}))
+
+    quantized = _quantize(segments, images, 'frame')
+    record(f"{prefix}/encode", lambda: _encode(quantized, duration))
+    quantized = None
+
+    frames = [frame for frames in segments for frame in frames]
+    for name, output_format in FULL_COLOR_CASES:
+        record(f"{prefix}/encode/{name}", lambda: _encode(frames, duration, output_format))
+
+
+def run_suite(sizes, counts, num_frames=10, repeat=3, duration=100, log=None):
+    # Time every stage for every image set. Returns {case: result}.
+    results = {}
+
+    def record(case, fn):
+        results[case] = measure(fn, repeat)
+        if log is not None:
+            log(case, results[case])
+
+    for width, height in sizes:
+        for count in counts:
+            _bench_set(record, f"{width}x{height}x{count}", (width, height), count, num_frames, duration)
+    return results
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(results, baseline, threshold):
+    # Cases that got worse than the baseline by more than threshold (a
+    # fraction). Returns a list of (case, what, baseline value, new value).
+    regressions = []
+    for case, old in baseline.items():
+        new = results.get(case)
+        if new is None:
+            continue
+        if old.get('fps') and new['fps'] < old['fps'] * (1 - threshold):
+            regressions.append((case, 'fps', old['fps'], new['fps']))
+        if old.get('bytes') and new.get('bytes', 0) > old['bytes'] * (1 + threshold):
+            regressions.append((case, 'bytes', old['bytes'], new['bytes']))
+        if old.get('peak_rss') and new['peak_rss'] > old['peak_rss'] * (1 + threshold) + RSS_SLACK:
+            regressions.append((case, 'peak_rss', old['peak_rss'], new['peak_rss']))
+    return regressions
+
+
+def _parse_sizes(value):
+    sizes = []
+    for part in value.split(","):
+        width, _, height = part.strip().partition("x")
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+def _parse_counts(value):
+    counts = [int(part) for part in value.split(",")]
+    if any(count < 2 for count in counts):
+        raise argparse.ArgumentTypeError("image counts must be at least 2")
+    return counts
+
+
+def _print_result(case, result):
+    line = f"{case:<48} {result['fps']:>9.1f} fps {result['peak_rss'] / 1024 / 1024:>8.1f} MB"
+    if 'bytes' in result:
+        line += f" {result['bytes']:>10} bytes"
+    print(line, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m gifcore.bench", description="Benchmark the GIF render pipeline")
+    parser.add_argument("--sizes", type=_parse_sizes, default=DEFAULT_SIZES,
+                        help=f"comma separated WIDTHxHEIGHT image sizes (default {DEFAULT_SIZES})")
+    parser.add_argument("--counts", type=_parse_counts, default=DEFAULT_COUNTS,
+                        help=f"comma separated numbers of images per set (default {DEFAULT_COUNTS})")
+    parser.add_argument("--frames", type=int, default=10, help="frames per transition (default 10)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest is kept (default 3)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="how much worse than the baseline counts as a regression (default 0.1)")
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.sizes, args.counts, num_frames=args.frames, repeat=args.repeat, log=_print_result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2, sort_keys=True)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('environment') != environment():
+        print("Warning: the baseline was recorded in a different environment", file=sys.stderr)
+
+    regressions = compare(results, baseline['results'], args.threshold)
+    for case, what, old, new in regressions:
+        print(f"REGRESSION {case} {what}: {old:.1f} -> {new:.1f}")
+    if not regressions:
+        print(f"No regressions against {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
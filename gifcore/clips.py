@@ -0,0 +1,81 @@
+from PIL import Image, ImageSequence
+
+from gifcore.normalize import Normalizer
+from gifcore.trace import span
+
+# Frames a clip is cut down to, by sampling it more sparsely, when an upload
+# doesn't ask for another limit
+DEFAULT_MAX_FRAMES = 300
+
+
+def frame_count(path):
+    # Number of frames in an image file, 1 for a still image
+    with Image.open(path) as img:
+        return getattr(img, 'n_frames', 1)
+
+
+def sampled_frames(count, stride=1, max_frames=0):
+    # Indexes of the frames a clip plays: every stride-th frame, spaced out
+    # further if needed so there are at most max_frames (0 for no limit)
+    if max_frames:
+        stride = max(stride, -(-count // max_frames))
+    return range(0, count, stride)
+
+
+def clip_options(path, stride=1, max_frames=DEFAULT_MAX_FRAMES):
+    # What a session keeps about a multi-frame upload (an animated GIF,
+    # WebP or PNG) to play it as a clip, or None for a still image
+    if stride < 1:
+        raise ValueError("Stride must be 1 or greater")
+    if max_frames < 0:
+        raise ValueError("Maximum frames must be 0 or greater")
+
+    count = frame_count(path)
+    if count <= 1:
+        return None
+    return {'frames': count, 'stride': stride, 'max_frames': max_frames}
+
+
+class Clip:
+    # A multi-frame image that takes the place of a still one: its sampled
+    # frames play one after the other, and transitions run into its first
+    # frame and out of its last. Frames are decoded one at a time as they are
+    # played, so a clip with thousands of frames holds no more memory than a
+    # still image.
+
+    def __init__(self, path, size, first, frames, stride=1, max_frames=0, normalizer=None):
+        self.path = path
+        self.size = size
+        self.first = first
+        self.indexes = sampled_frames(frames, stride, max_frames)
+        self.normalizer = normalizer if normalizer is not None else Normalizer(fit='stretch')
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __iter__(self):
+        # The sampled frames as RGB images fitted to size. The first one was
+        # already loaded, the others have to be read in order because GIF
+        # and APNG frames are drawn over the ones before them.
+        wanted = iter(self.indexes)
+        target = next(wanted, None)
+        with Image.open(self.path) as img:
+            for index, frame in enumerate(ImageSequence.Iterator(img)):
+                if index != target:
+                    continue
+                if index == 0:
+                    yield self.first
+                else:
+                    with span('open', 1):
+                        frame = frame.convert('RGB')
+                    with span('resize', 1):
+                        frame = self.normalizer.normalize(frame, self.size)
+                    yield frame
+                target = next(wanted, None)
+                if target is None:
+                    return
+
+
+def first_frame(item):
+    # The image transitions into item start from, for a still image or a clip
+    return item.first if isinstance(item, Clip) else item
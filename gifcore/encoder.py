@@ -0,0 +1,259 @@
+import io
+import math
+import os
+import struct
+
+from PIL import Image, ImageChops, ImageFile
+
+from gifcore.quantize import Quantizer
+
+
+def _table_size(num_colors):
+    # GIF color tables hold a power of two number of entries, at least two
+    return 2 << max(0, math.ceil(math.log2(max(2, num_colors))) - 1)
+
+
+def _color_table(frame):
+    # Return the (flags, bytes) pair for a frame's color table, padded with
+    # black to the size a GIF color table needs
+    palette_bytes = bytes(frame.palette.palette) if frame.palette else b""
+    num_entries = _table_size(len(palette_bytes) // 3)
+    size_bits = num_entries.bit_length() - 2
+    return size_bits, palette_bytes + b"\x00" * (3 * num_entries - len(palette_bytes))
+
+
+def _drop_unused_colors(frame):
+    # A cropped frame often uses only part of its palette. Keep just those
+    # colors, plus room for a transparent index, when that makes its color
+    # table smaller.
+    used = [i for i, count in enumerate(frame.histogram()) if count]
+    if _table_size(len(used) + 1) < _table_size(len(frame.palette.palette) // 3):
+        return frame.remap_palette(used)
+    return frame
+
+
+# Graphic control extension disposal method: leave the frame in place, so
+# the next frame only has to draw what changed
+DISPOSAL_KEEP = 1
+
+# Longest delay in milliseconds a single GIF frame can hold, as the graphic
+# control extension stores it in hundredths of a second in 16 bits
+MAX_DELAY = 65535 * 10
+
+# Only try making unchanged pixels transparent when at least this share of a
+# cropped frame is unchanged. Below that it hardly ever makes a difference.
+MIN_UNCHANGED = 0.05
+
+
+def _frame_delta(previous, frame):
+    # An image that is zero wherever two palette frames show the same color
+    if previous.palette.palette == frame.palette.palette:
+        return ImageChops.subtract_modulo(frame, previous)
+    return ImageChops.subtract_modulo(frame.convert("RGB"), previous.convert("RGB"))
+
+
+def _changed_mask(delta):
+    # 255 for every pixel that changed, 0 for the rest
+    if delta.mode == "RGB":
+        r, g, b = delta.split()
+        delta = ImageChops.lighter(ImageChops.lighter(r, g), b)
+    else:
+        delta = Image.frombytes("L", delta.size, delta.tobytes())
+    return delta.point([0] + [255] * 255)
+
+
+def _lzw(frame):
+    # LZW encoded pixel data of a palette frame
+    data = io.BytesIO()
+    ImageFile._save(frame, data, [("gif", (0, 0) + frame.size, 0, "P")])
+    return data.getvalue()
+
+
+def _encode_delta(frame, delta, num_colors):
+    # Encode a cropped frame, trying it with the pixels that are unchanged
+    # from the previous frame made transparent as well. That turns them into
+    # runs of one index, which often compresses better but can also break up
+    # runs the frame already had, so keep whichever comes out smaller.
+    # Returns (transparent index or None, encoded pixels).
+    data = _lzw(frame)
+
+    changed = _changed_mask(delta)
+    if changed.histogram()[0] < MIN_UNCHANGED * frame.width * frame.height:
+        return None, data
+
+    counts = frame.histogram(mask=changed)
+    index = next((i for i in range(num_colors) if not counts[i]), None)
+    if index is None:
+        # Every color is in use, so none can stand in for transparency
+        return None, data
+
+    frame = frame.copy()
+    frame.paste(index, mask=ImageChops.invert(changed))
+    transparent_data = _lzw(frame)
+    if len(transparent_data) < len(data):
+        return index, transparent_data
+    return None, data
+
+
+class GifStreamWriter:
+    # Writes an animated GIF one frame at a time. Each frame is held back
+    # until the next one arrives, so consecutive duplicates can be merged and
+    # only the changed region is encoded. Inside that region, pixels that
+    # still match the previous frame are made transparent when that makes the
+    # frame smaller. At most two quantized frames are kept in memory.
+    # RGB frames are quantized with the given Quantizer, palette frames are
+    # written as they are.
+
+    def __init__(self, fp, duration=100, loop=0, quantizer=None):
+        self.fp = fp
+        self.duration = duration
+        self.loop = loop
+        self.quantizer = quantizer or Quantizer()
+        self.frame_count = 0
+        self._global_table = None
+        self._previous = None
+        self._pending = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+    def _write_header(self, frame):
+        size_bits, table = _color_table(frame)
+
+        # Logical screen descriptor with the first frame's palette as the
+        # global color table
+        self.fp.write(b"GIF89a" + struct.pack("<HHBBB", frame.width, frame.height, 0x80 | size_bits, 0, 0))
+        self.fp.write(table)
+        self._global_table = table
+
+        if self.loop is not None:
+            self.fp.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", self.loop) + b"\x00")
+
+    def _write_frame(self, frame, duration, bbox, delta):
+        if self.frame_count == 0:
+            self._write_header(frame)
+            flags = 0
+            table = b""
+            offset = (0, 0)
+            transparency, data = None, _lzw(frame)
+        else:
+            offset = bbox[:2]
+            frame = frame.crop(bbox)
+
+            # Later frames only carry a palette of their own when it differs
+            # from the global one
+            if _color_table(frame)[1] == self._global_table:
+                flags = 0
+                table = b""
+            else:
+                frame = _drop_unused_colors(frame)
+                size_bits, table = _color_table(frame)
+                flags = 0x80 | size_bits
+            num_colors = len(table or self._global_table) // 3
+            transparency, data = _encode_delta(frame, delta, num_colors)
+
+        # Graphic control extension holding the disposal method, transparent
+        # index and frame delay
+        packed = DISPOSAL_KEEP << 2
+        if transparency is None:
+            transparency = 0
+        else:
+            packed |= 1
+        self.fp.write(b"!\xf9\x04" + struct.pack("<BHB", packed, int(duration / 10), transparency) + b"\x00")
+
+        # Image descriptor, local color table and LZW encoded pixels
+        self.fp.write(b"," + struct.pack("<HHHHB", offset[0], offset[1], frame.width, frame.height, flags))
+        self.fp.write(table)
+        self.fp.write(b"\x08")
+        self.fp.write(data)
+        self.fp.write(b"\x00")
+
+        self.frame_count += 1
+
+    def write(self, frame, duration=None):
+        frame = self.quantizer.quantize(frame)
+        frame.load()
+        if duration is None:
+            duration = self.duration
+
+        # Delays longer than a frame can hold are split over repeats of it
+        while duration > MAX_DELAY:
+            self._add(frame, MAX_DELAY)
+            duration -= MAX_DELAY
+        self._add(frame, duration)
+
+    def _add(self, frame, duration):
+        bbox = delta = None
+        if self._previous is not None:
+            delta = _frame_delta(self._previous, frame)
+            bbox = delta.getbbox()
+            if not bbox:
+                if self._pending is not None and self._pending[1] + duration <= MAX_DELAY:
+                    # Identical to the frame before it, so just show that one longer
+                    self._pending[1] += duration
+                    return
+                # The frame before was already flushed or can't be shown any
+                # longer, so redraw one pixel
+                bbox = (0, 0, 1, 1)
+            delta = delta.crop(bbox)
+
+        if self._pending is not None:
+            self._write_frame(*self._pending)
+        self._pending = [frame, duration, bbox, delta]
+        self._previous = frame
+
+    def flush(self):
+        # Write out the frame being held back. Everything written so far is
+        # then final and the next frame won't be merged into it, so the bytes
+        # written between two flushes can be stored and spliced into another
+        # GIF later.
+        if self._pending is not None:
+            self._write_frame(*self._pending)
+            self._pending = None
+
+    def checkpoint(self):
+        # What a writer needs to carry on after the frames written so far:
+        # the last frame shown and the global color table
+        return self._previous, self._global_table
+
+    def splice(self, data, frame_count, previous, global_table):
+        # Append frames that were written between two flushes of a writer
+        # with the same settings, after frames showing the same image as the
+        # ones before here. previous and global_table are that writer's
+        # checkpoint() afterwards.
+        self.flush()
+        self.fp.write(data)
+        self.frame_count += frame_count
+        self._previous = previous
+        self._global_table = global_table
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self._previous = None
+        self._closed = True
+
+        if self.frame_count:
+            self.fp.write(b";")
+            self.fp.flush()
+
+
+def save_gif(path, frames, duration=100, loop=0, quantizer=None):
+    # Encode an iterable of frames straight to disk. Frames are pulled from
+    # the iterable one by one, so a generator keeps peak memory to a frame
+    # or two regardless of how long the animation is.
+    with open(path, "wb") as fp:
+        with GifStreamWriter(fp, duration=duration, loop=loop, quantizer=quantizer) as writer:
+            for frame in frames:
+                writer.write(frame)
+
+    if writer.frame_count == 0:
+        os.remove(path)
+        raise ValueError("No frames to write")
+    return writer.frame_count
@@ -0,0 +1,109 @@
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024
+DEFAULT_TIMEOUT = 10
+CHUNK_SIZE = 64 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class FetchError(Exception):
+    # A fetch we refused to finish, with the HTTP status to report it as
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def get_session(pool_size=16):
+    # One connection-pooled session per process, so repeated fetches from
+    # the same host reuse their connections instead of handshaking each time
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def validate_url(url):
+    try:
+        parsed_url = urlparse(url)
+    except Exception:
+        raise FetchError('Invalid URL format')
+    if parsed_url.scheme not in ('http', 'https') or not parsed_url.netloc:
+        raise FetchError('Invalid URL format')
+
+
+def _limited_chunks(response, max_bytes):
+    # Body chunks, stopping as soon as the size limit is passed
+    received = 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        received += len(chunk)
+        if received > max_bytes:
+            raise FetchError(f'Image is larger than {max_bytes / (1024 * 1024):.3g} MB', 413)
+        yield chunk
+
+
+def _open(url, max_bytes, timeout):
+    # Start a streamed GET and check the headers before any of the body is read
+    validate_url(url)
+    response = get_session().get(url, stream=True, timeout=timeout)
+    try:
+        response.raise_for_status()
+
+        content_type = response.headers.get('Content-Type', '')
+        if not content_type.startswith('image/'):
+            raise FetchError(f'URL does not point to an image: {content_type}')
+
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            raise FetchError(f'Image is larger than {max_bytes / (1024 * 1024):.3g} MB', 413)
+    except Exception:
+        response.close()
+        raise
+    return response
+
+
+def fetch_to_store(url, store, max_bytes=DEFAULT_MAX_BYTES, timeout=DEFAULT_TIMEOUT):
+    # Stream an image into a BlobStore. Returns (digest, path).
+    with _open(url, max_bytes, timeout) as response:
+        return store.put_chunks(_limited_chunks(response, max_bytes))
+
+
+def fetch_to_file(url, path, max_bytes=DEFAULT_MAX_BYTES, timeout=DEFAULT_TIMEOUT):
+    # Stream an image to a file, never leaving a partial file behind
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with _open(url, max_bytes, timeout) as response:
+            with open(tmp_path, 'wb') as f:
+                for chunk in _limited_chunks(response, max_bytes):
+                    f.write(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+def fetch_many(fetch, urls, concurrency=8):
+    # Run fetch(url) for every url with at most `concurrency` in flight.
+    # Returns (result, error) pairs in the same order as urls.
+    def attempt(url):
+        try:
+            return fetch(url), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(urls)))) as executor:
+        return list(executor.map(attempt, urls))
@@ -0,0 +1,280 @@
+import io
+import os
+import struct
+import tempfile
+import zlib
+
+from PIL import Image, ImageChops
+
+from gifcore.encoder import GifStreamWriter
+
+# Output formats: file extension and MIME type. APNG files are PNG files
+# with extra chunks, named and served like any other PNG.
+OUTPUT_FORMATS = {
+    'gif': ('.gif', 'image/gif'),
+    'webp': ('.webp', 'image/webp'),
+    'apng': ('.png', 'image/png'),
+}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Frames waiting to be encoded as WebP are kept in memory up to this many
+# bytes, then moved to a temporary file
+SPOOL_MEMORY = 16 * 1024 * 1024
+
+
+def _chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def _png_data(frame, compress_level):
+    # The compressed pixel data of a frame, as Pillow's PNG encoder makes it
+    buffer = io.BytesIO()
+    frame.save(buffer, format="PNG", compress_level=compress_level)
+    png = buffer.getvalue()
+
+    data = []
+    offset = len(PNG_SIGNATURE)
+    while offset < len(png):
+        length, kind = struct.unpack_from(">I4s", png, offset)
+        if kind == b"IDAT":
+            data.append(png[offset + 8:offset + 8 + length])
+        offset += 12 + length
+    return b"".join(data)
+
+
+class ApngStreamWriter:
+    # Writes an animated PNG one frame at a time, in full color. Like
+    # GifStreamWriter, a frame is held back until the next one arrives so
+    # duplicates can be merged, and later frames only hold the region that
+    # changed. The frame count goes in the header, so the encoded frames are
+    # kept in a temporary file until close() writes the whole file out.
+
+    def __init__(self, fp, duration=100, loop=0, compress_level=6):
+        self.fp = fp
+        self.duration = duration
+        self.loop = loop
+        self.compress_level = compress_level
+        self.frame_count = 0
+        self.durations = []
+        self._size = None
+        self._sequence = 0
+        self._previous = None
+        self._pending = None
+        self._spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._spool.close()
+
+    def _write_frame(self, frame, duration, offset):
+        # Frame control chunk: size, position, delay in milliseconds, and
+        # leave the frame in place for the next one to draw over
+        delay = min(int(duration), 0xFFFF)
+        self._spool.write(_chunk(b"fcTL", struct.pack(
+            ">IIIIIHHBB", self._sequence, frame.width, frame.height, offset[0], offset[1], delay, 1000, 0, 0
+        )))
+        self._sequence += 1
+
+        data = _png_data(frame, self.compress_level)
+        if self.frame_count == 0:
+            self._spool.write(_chunk(b"IDAT", data))
+        else:
+            self._spool.write(_chunk(b"fdAT", struct.pack(">I", self._sequence) + data))
+            self._sequence += 1
+
+        self.frame_count += 1
+        self.durations.append(duration)
+
+    def write(self, frame, duration=None):
+        if frame.mode != "RGB":
+            frame = frame.convert("RGB")
+        frame.load()
+        if duration is None:
+            duration = self.duration
+
+        offset = (0, 0)
+        shown = frame
+        if self._previous is None:
+            self._size = frame.size
+        else:
+            bbox = ImageChops.difference(frame, self._previous).getbbox()
+            if not bbox:
+                if self._pending is not None:
+                    # Identical to the frame before it, so just show that one longer
+                    self._pending[1] += duration
+                    return
+                # The frame before was already flushed, so redraw one pixel
+                bbox = (0, 0, 1, 1)
+            offset = bbox[:2]
+            shown = frame.crop(bbox)
+
+        if self._pending is not None:
+            self._write_frame(*self._pending)
+        self._pending = [shown, duration, offset]
+        self._previous = frame
+
+    def flush(self):
+        if self._pending is not None:
+            self._write_frame(*self._pending)
+            self._pending = None
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self._previous = None
+        self._closed = True
+
+        try:
+            if not self.frame_count:
+                return
+            self.fp.write(PNG_SIGNATURE)
+            self.fp.write(_chunk(b"IHDR", struct.pack(">IIBBBBB", self._size[0], self._size[1], 8, 2, 0, 0, 0)))
+            self.fp.write(_chunk(b"acTL", struct.pack(">II", self.frame_count, self.loop or 0)))
+            self._spool.seek(0)
+            for data in iter(lambda: self._spool.read(1024 * 1024), b""):
+                self.fp.write(data)
+            self.fp.write(_chunk(b"IEND", b""))
+            self.fp.flush()
+        finally:
+            self._spool.close()
+
+
+class WebPStreamWriter:
+    # Writes an animated WebP. Pillow's WebP encoder wants every frame up
+    # front, so frames are first written as a quickly compressed APNG in a
+    # temporary file, which close() hands to the encoder to read back one
+    # frame at a time. Memory stays at a frame or two plus the output.
+
+    def __init__(self, fp, duration=100, loop=0, lossless=False, quality=80, method=4):
+        self.fp = fp
+        self.loop = loop
+        self.lossless = lossless
+        self.quality = quality
+        self.method = method
+        self._spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+        self._frames = ApngStreamWriter(self._spool, duration=duration, loop=loop, compress_level=1)
+        self._closed = False
+
+    @property
+    def frame_count(self):
+        return self._frames.frame_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._frames.__exit__(exc_type, exc, tb)
+            self._spool.close()
+
+    def write(self, frame, duration=None):
+        self._frames.write(frame, duration)
+
+    def flush(self):
+        self._frames.flush()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        try:
+            self._frames.close()
+            if not self.frame_count:
+                return
+            self._spool.seek(0)
+            with Image.open(self._spool) as frames:
+                frames.save(
+                    self.fp,
+                    format="WEBP",
+                    save_all=True,
+                    duration=self._frames.durations,
+                    loop=self.loop or 0,
+                    lossless=self.lossless,
+                    quality=self.quality,
+                    method=self.method,
+                )
+            self.fp.flush()
+        finally:
+            self._spool.close()
+
+
+class OutputFormat:
+    # The file format a render is written in, with its settings:
+    #   gif  - 256 colors a frame, quantized by the render's Quantizer
+    #   webp - full color, lossy at quality 0-100 or lossless; method 0-6
+    #          trades encoding speed (0) for smaller files (6)
+    #   apng - full color and lossless, larger than WebP but plays anywhere
+    #          PNG does
+    # Picklable, so it can be handed to render jobs.
+
+    def __init__(self, name='gif', lossless=False, quality=80, method=4):
+        if name not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {name}")
+        if not 0 <= quality <= 100:
+            raise ValueError("Quality must be between 0 and 100")
+        if not 0 <= method <= 6:
+            raise ValueError("Method must be between 0 and 6")
+
+        self.name = name
+        self.lossless = lossless
+        self.quality = quality
+        self.method = method
+
+    @property
+    def extension(self):
+        return OUTPUT_FORMATS[self.name][0]
+
+    @property
+    def mimetype(self):
+        return OUTPUT_FORMATS[self.name][1]
+
+    @property
+    def quantized(self):
+        # Whether frames have to be brought down to a palette first
+        return self.name == 'gif'
+
+    def settings(self):
+        # Everything that changes the output, for render keys. Empty for GIF,
+        # so GIFs keep the keys they had before there were other formats.
+        if self.name == 'webp':
+            return {'format': self.name, 'lossless': self.lossless, 'quality': self.quality, 'method': self.method}
+        if self.name == 'apng':
+            return {'format': self.name, 'method': self.method}
+        return {}
+
+    def writer(self, fp, duration=100, loop=0, quantizer=None):
+        # A writer for this format: write(frame, duration=None), flush(),
+        # close() and frame_count, usable as a context manager
+        if self.name == 'webp':
+            return WebPStreamWriter(fp, duration, loop, self.lossless, self.quality, self.method)
+        if self.name == 'apng':
+            # Higher methods spend longer compressing, like WebP's
+            return ApngStreamWriter(fp, duration, loop, compress_level=min(9, 3 + self.method))
+        return GifStreamWriter(fp, duration=duration, loop=loop, quantizer=quantizer)
+
+
+def save_animation(path, frames, output_format=None, duration=100, loop=0, quantizer=None):
+    # Like save_gif, in any output format
+    if output_format is None:
+        output_format = OutputFormat()
+
+    with open(path, "wb") as fp:
+        with output_format.writer(fp, duration, loop, quantizer) as writer:
+            for frame in frames:
+                writer.write(frame)
+
+    if writer.frame_count == 0:
+        os.remove(path)
+        raise ValueError("No frames to write")
+    return writer.frame_count
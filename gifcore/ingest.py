@@ -0,0 +1,30 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class IngestPool:
+    # Threads that process new uploads: hashing them into the store,
+    # decoding them upright and making their thumbnails. Pillow lets go of
+    # the GIL while it decodes and resizes, so uploads are processed on
+    # every core at once. One pool is shared by every request of a process,
+    # so a big batch waits its turn instead of starting threads of its own.
+
+    def __init__(self, workers=None):
+        workers = workers or os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError("Ingest workers must be 1 or greater")
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest')
+
+    def process(self, work, items):
+        # Run work(item) for every item, yielding (position, result, error)
+        # as each one finishes, where position is the item's place in items.
+        # Items not started yet are dropped if the caller stops early.
+        futures = {self._executor.submit(work, item): position for position, item in enumerate(items)}
+        try:
+            for future in as_completed(futures):
+                error = future.exception()
+                yield futures[future], future.result() if error is None else None, error
+        finally:
+            for future in futures:
+                future.cancel()
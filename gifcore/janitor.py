@@ -0,0 +1,213 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Files changed this recently are never evicted, they may still be being
+# written or downloaded
+MIN_AGE = 60
+
+
+def mark_used(path):
+    # Bump a rendered GIF to the front of the eviction order
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove(path):
+    # Delete a file and return the bytes freed
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+def _list_files(directory):
+    # (path, size, mtime) for every finished file directly in directory
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((entry.path, stat.st_size, stat.st_mtime))
+    return files
+
+
+class Janitor:
+    # Background cleanup of everything a session leaves behind:
+    #
+    # - sessions not changed or rendered for session_ttl seconds are dropped
+    # - uploads are stored once per content and shared between sessions, so
+    #   one is only deleted (with its thumbnail and decoded copy) once no
+    #   session refers to it and it has not been stored again for
+    #   upload_grace seconds
+    # - rendered GIFs older than output_ttl are deleted, and the least
+    #   recently used ones after that until they fit in output_quota bytes
+    # - finished render jobs are forgotten after output_ttl
+    # - cached segments are trimmed back to their cache's size limit
+    # - metrics files of worker processes that have exited are removed
+    #
+    # Every worker process can run one, removing a file twice is harmless.
+
+    def __init__(self, sessions, uploads, output_dir, thumbnails=None, jobs=None, segments=None, raws=None, metrics=None,
+                 session_ttl=24 * 60 * 60, upload_grace=60 * 60,
+                 output_ttl=24 * 60 * 60, output_quota=1024 * 1024 * 1024, interval=300):
+        self.sessions = sessions
+        self.uploads = uploads
+        self.output_dir = output_dir
+        self.thumbnails = thumbnails
+        self.jobs = jobs
+        self.segments = segments
+        self.raws = raws
+        self.metrics = metrics
+        self.session_ttl = session_ttl
+        self.upload_grace = upload_grace
+        self.output_ttl = output_ttl
+        self.output_quota = output_quota
+        self.interval = interval
+
+        self.stats = {
+            'runs': 0,
+            'last_run': None,
+            'sessions_expired': 0,
+            'uploads_removed': 0,
+            'outputs_removed': 0,
+            'jobs_removed': 0,
+            'segments_removed': 0,
+            'metrics_removed': 0,
+            'bytes_reclaimed': 0,
+        }
+        self._lock = threading.Lock()
+        self._thread = None
+        self._next_run = time.time() + interval
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="janitor", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Janitor run failed")
+
+    def run_if_due(self, now=None):
+        # For processes that can't keep a thread running between requests:
+        # one cleanup pass if interval seconds have passed since the last
+        # one. Returns what it removed, or None when no pass was due.
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if now < self._next_run:
+                return None
+            self._next_run = now + self.interval
+        return self.run_once(now)
+
+    def run_once(self, now=None):
+        # One full cleanup pass. Returns what it removed.
+        if now is None:
+            now = time.time()
+
+        result = {
+            'sessions_expired': self.sessions.expire(now - self.session_ttl),
+            'uploads_removed': 0,
+            'outputs_removed': 0,
+            'jobs_removed': 0,
+            'segments_removed': 0,
+            'metrics_removed': 0,
+            'bytes_reclaimed': 0,
+        }
+        self._sweep_uploads(now, result)
+        self._sweep_outputs(now, result)
+        if self.jobs is not None:
+            removed, freed = self.jobs.expire(now - self.output_ttl)
+            result['jobs_removed'] += removed
+            result['bytes_reclaimed'] += freed
+        if self.segments is not None:
+            removed, freed = self.segments.trim(keep_after=now - MIN_AGE)
+            result['segments_removed'] += removed
+            result['bytes_reclaimed'] += freed
+        if self.metrics is not None:
+            result['metrics_removed'] = self.metrics.prune()
+
+        with self._lock:
+            for key, value in result.items():
+                self.stats[key] += value
+            self.stats['runs'] += 1
+            self.stats['last_run'] = now
+        return result
+
+    def _sweep_uploads(self, now, result):
+        # Take the references before listing the files, so an upload added
+        # to a session in between is still inside its grace period
+        refcounts = self.sessions.image_refcounts()
+        referenced = {os.path.abspath(path) for path, count in refcounts.items() if count > 0}
+
+        for digest, path, size, mtime in list(self.uploads.blobs()):
+            if os.path.abspath(path) in referenced or mtime > now - self.upload_grace:
+                continue
+            freed = _remove(path)
+            if self.thumbnails is not None:
+                freed += _remove(self.thumbnails.path_for(digest))
+            if self.raws is not None:
+                freed += _remove(self.raws.path_for(digest))
+            result['uploads_removed'] += 1
+            result['bytes_reclaimed'] += freed
+
+    def _sweep_outputs(self, now, result):
+        # Oldest first, so expired files go before the quota is checked
+        files = sorted(_list_files(self.output_dir), key=lambda f: f[2])
+        total = sum(size for _, size, _ in files)
+
+        for path, size, mtime in files:
+            if mtime > now - MIN_AGE:
+                break
+            if mtime >= now - self.output_ttl and total <= self.output_quota:
+                break
+            total -= size
+            result['outputs_removed'] += 1
+            result['bytes_reclaimed'] += _remove(path)
+
+    def footprint(self):
+        # What is currently stored
+        uploads = list(self.uploads.blobs())
+        outputs = _list_files(self.output_dir)
+        thumbnail_bytes = 0
+        if self.thumbnails is not None:
+            thumbnail_bytes = sum(size for _, size, _ in _list_files(self.thumbnails.root))
+        segment_bytes = 0
+        if self.segments is not None:
+            segment_bytes = sum(size for _, size, _ in _list_files(self.segments.root))
+        raw_bytes = 0
+        if self.raws is not None:
+            raw_bytes = sum(size for _, size in self.raws.files())
+        return {
+            'sessions': self.sessions.count(),
+            'upload_files': len(uploads),
+            'upload_bytes': sum(blob[2] for blob in uploads),
+            'thumbnail_bytes': thumbnail_bytes,
+            'raw_bytes': raw_bytes,
+            'output_files': len(outputs),
+            'output_bytes': sum(size for _, size, _ in outputs),
+            'segment_bytes': segment_bytes,
+        }
+
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats.update(self.footprint())
+        return stats
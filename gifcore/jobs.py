@@ -0,0 +1,267 @@
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full, Queue
+
+
+# A queued or running job whose state file has not been touched for this
+# long is assumed to belong to a worker that died
+STALE_AFTER = 10 * 60
+
+# How often a worker touches the state files of its queued and running jobs,
+# so ones that wait or render for a long time without progress aren't taken
+# for abandoned
+HEARTBEAT_INTERVAL = 60
+
+
+class QueueFull(Exception):
+    pass
+
+
+def run_ahead(executor, chunks, ahead=4):
+    # Iterate chunks on one of executor's threads, handing them over
+    # through a queue of up to ahead chunks. The calling thread only waits,
+    # so however many requests read CPU-heavy generators, only as many run
+    # at once as the executor has threads. Errors are raised in the caller,
+    # and closing the returned generator stops the producer.
+    queue = Queue(maxsize=ahead)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            if stop.is_set():
+                return
+            for chunk in chunks:
+                if not put((chunk, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    executor.submit(produce)
+    try:
+        while True:
+            chunk, error = queue.get()
+            if error is not None:
+                raise error
+            if chunk is done:
+                return
+            yield chunk
+    finally:
+        stop.set()
+
+
+class JobQueue:
+    # Runs render jobs on a small pool of background threads so requests
+    # can return straight away.
+    #
+    # Job state is written to a JSON file per job in state_dir rather than
+    # kept in memory, so a status poll answered by a different gunicorn
+    # worker than the one running the job still sees its progress.
+
+    def __init__(self, state_dir, workers=2, max_queued=8):
+        self.state_dir = state_dir
+        self.workers = workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="render")
+        self._lock = threading.Lock()
+        self._active = 0
+        self._beating = set()
+        self._heartbeat = None
+
+        os.makedirs(state_dir, exist_ok=True)
+
+    def _state_path(self, job_id):
+        return os.path.join(self.state_dir, f"{job_id}.json")
+
+    def _write_state(self, job):
+        # Write to a temporary file first so readers never see half a job
+        path = self._state_path(job['id'])
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+
+    def get(self, job_id):
+        # Only hex ids are ever handed out, anything else can't be a job
+        try:
+            uuid.UUID(hex=job_id)
+        except ValueError:
+            return None
+
+        try:
+            with open(self._state_path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def expire(self, cutoff):
+        # Delete the state of jobs that finished before cutoff. Returns the
+        # number of jobs removed and the bytes freed.
+        removed = freed = 0
+        for name in os.listdir(self.state_dir):
+            if not name.endswith('.json'):
+                continue
+            job = self.get(name[:-5])
+            if job is None or job.get('finished', cutoff) >= cutoff:
+                continue
+            path = self._state_path(job['id'])
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += size
+        return removed, freed
+
+    def pending(self):
+        with self._lock:
+            return self._active
+
+    def submit(self, fn, *args, **kwargs):
+        # Queue fn(progress, *args, **kwargs) and return the new job id.
+        # fn reports progress by calling progress(done, total) and returns
+        # a dict that becomes the job's result.
+        self._reserve()
+        job = self._new_job(uuid.uuid4().hex)
+        self._write_state(job)
+        self._start(job, fn, args, kwargs)
+        return job['id']
+
+    def submit_once(self, job_id, fn, *args, **kwargs):
+        # Like submit, but under a job id chosen by the caller, and only if
+        # no job with that id is queued or running already. Otherwise the
+        # existing job's id is returned, so identical requests share one job
+        # even when they arrive at different worker processes.
+        uuid.UUID(hex=job_id)
+
+        # Joining a job that is already running takes no place in the
+        # queue, so it works even when the queue is full
+        if self._live(job_id):
+            return job_id
+
+        self._reserve()
+        job = self._new_job(job_id)
+        if not self._claim(job):
+            self._release()
+            return job_id
+        self._start(job, fn, args, kwargs)
+        return job_id
+
+    def _reserve(self):
+        with self._lock:
+            if self._active >= self.workers + self.max_queued:
+                raise QueueFull("Render queue is full")
+            self._active += 1
+
+    def _new_job(self, job_id):
+        return {
+            'id': job_id,
+            'status': 'queued',
+            'progress': 0.0,
+            'result': None,
+            'message': None,
+            'created': time.time(),
+        }
+
+    def _claim(self, job):
+        # Write the state of a new job unless a live job already has its id.
+        # Linking a finished file into place fails if one exists, so only one
+        # process can claim a free id and readers never see half a file.
+        path = self._state_path(job['id'])
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        try:
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            if self._live(job['id']):
+                return False
+            # Finished, failed or abandoned by a worker that died, so run it again
+            os.replace(tmp_path, path)
+            return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _live(self, job_id):
+        # Whether a job with this id is queued or running, and has not been
+        # abandoned by a worker that died
+        existing = self.get(job_id)
+        try:
+            idle = time.time() - os.path.getmtime(self._state_path(job_id))
+        except FileNotFoundError:
+            return False
+        return existing is not None and existing['status'] in ('queued', 'running') and idle < STALE_AFTER
+
+    def _start(self, job, fn, args, kwargs):
+        with self._lock:
+            self._beating.add(job['id'])
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, name="job-heartbeat", daemon=True)
+                self._heartbeat.start()
+        try:
+            self._executor.submit(self._run, job, fn, args, kwargs)
+        except RuntimeError:
+            with self._lock:
+                self._beating.discard(job['id'])
+            self._release()
+            raise
+
+    def _beat(self):
+        # Keep the state files of this worker's unfinished jobs fresh
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            with self._lock:
+                job_ids = list(self._beating)
+            for job_id in job_ids:
+                try:
+                    os.utime(self._state_path(job_id))
+                except FileNotFoundError:
+                    pass
+
+    def _release(self):
+        with self._lock:
+            self._active -= 1
+
+    def _run(self, job, fn, args, kwargs):
+        def progress(done, total):
+            job['progress'] = round(done / total, 3) if total else 0.0
+            self._write_state(job)
+
+        try:
+            job['status'] = 'running'
+            job['started'] = time.time()
+            self._write_state(job)
+
+            job['result'] = fn(progress, *args, **kwargs)
+            job['status'] = 'done'
+            job['progress'] = 1.0
+        except Exception as e:
+            job['status'] = 'error'
+            job['message'] = str(e)
+        finally:
+            self._release()
+            job['finished'] = time.time()
+            self._write_state(job)
+            with self._lock:
+                self._beating.discard(job['id'])
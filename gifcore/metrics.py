@@ -0,0 +1,231 @@
+import json
+import os
+import threading
+import uuid
+
+# Upper bounds of the histogram buckets, in seconds or bytes
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RENDER_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+MEMORY_BUCKETS = tuple(mb * 1024 * 1024 for mb in (64, 128, 256, 512, 1024, 2048, 4096))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _alive(pid):
+    # Whether a process is still running. Windows has no signal 0 to ask
+    # with, so there every process is taken to be alive.
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    # Counters and histograms, served in the Prometheus text format.
+    #
+    # Every worker process keeps its own. Given a directory, each one saves
+    # its values there (within save_interval seconds of a change) and
+    # render() adds up all the saved files, so whichever worker answers a
+    # scrape reports the totals for all of them. Files are named after the
+    # process id and a token of their own, so a new process that is given
+    # the id of an old one never overwrites its file. prune() removes the
+    # files of processes that have exited.
+
+    def __init__(self, directory=None, save_interval=1.0):
+        self.directory = directory
+        self.save_interval = save_interval
+        self._definitions = {}
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._timer = None
+        self._owner = None
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name, help):
+        self._definitions[name] = ('counter', help, None)
+
+    def histogram(self, name, help, buckets):
+        self._definitions[name] = ('histogram', help, tuple(sorted(buckets)))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._changed()
+
+    def observe(self, name, value, **labels):
+        buckets = self._definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            # A count for each bucket and one past the last, then the sum
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+            values[index] += 1
+            values[-1] += value
+        self._changed()
+
+    def _snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, list(labels), list(values)] for (name, labels), values in self._histograms.items()],
+            }
+
+    def _changed(self):
+        # Save a little later, so a burst of changes is written once
+        if self.directory is None:
+            return
+        with self._lock:
+            if self._timer is not None and self._timer[1] == os.getpid():
+                return
+            timer = threading.Timer(self.save_interval, self._save)
+            timer.daemon = True
+            self._timer = (timer, os.getpid())
+        timer.start()
+
+    def _save(self):
+        with self._lock:
+            self._timer = None
+        snapshot = self._snapshot()
+
+        path = os.path.join(self.directory, self._file_name())
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _file_name(self):
+        # This process's file, with a new token after a fork
+        pid = os.getpid()
+        with self._lock:
+            if self._owner is None or self._owner[0] != pid:
+                self._owner = (pid, uuid.uuid4().hex)
+            return f"{pid}-{self._owner[1]}.json"
+
+    def prune(self):
+        # Delete the files of processes that are no longer running, so they
+        # don't pile up as workers are restarted. Their values drop out of
+        # the totals, which Prometheus treats as a counter reset. Returns
+        # the number of files removed.
+        if self.directory is None:
+            return 0
+
+        removed = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                pid = int(name[:-5].split("-")[0])
+            except ValueError:
+                continue
+            if pid == os.getpid() or _alive(pid):
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            removed += 1
+        return removed
+
+    def _collect(self):
+        # Every process's values added up
+        if self.directory is None:
+            snapshots = [self._snapshot()]
+        else:
+            self._save()
+            snapshots = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        counters = {}
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                totals = histograms.get(key)
+                if totals is None or len(totals) != len(values):
+                    histograms[key] = list(values)
+                else:
+                    histograms[key] = [a + b for a, b in zip(totals, values)]
+        return counters, histograms
+
+    def render(self):
+        counters, histograms = self._collect()
+
+        lines = []
+        for name, (kind, help, buckets) in sorted(self._definitions.items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name or len(values) != len(buckets) + 2:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ["+Inf"], values[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {values[-1]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def default_metrics(directory=None):
+    # The metrics both apps export
+    metrics = Metrics(directory)
+    metrics.histogram('gifmaker_http_request_duration_seconds', 'Time taken to answer HTTP requests, up to the first byte of the body', REQUEST_BUCKETS)
+    metrics.counter('gifmaker_renders_total', 'GIFs rendered')
+    metrics.histogram('gifmaker_render_duration_seconds', 'Time taken to render a GIF', RENDER_BUCKETS)
+    metrics.histogram('gifmaker_render_stage_end_rss_bytes', 'Highest resident memory of the worker at the end of any stage of a render, sampled when each stage ends', MEMORY_BUCKETS)
+    metrics.counter('gifmaker_render_stage_seconds_total', 'Wall time spent in each render stage')
+    metrics.counter('gifmaker_render_stage_cpu_seconds_total', 'CPU time spent in each render stage')
+    metrics.counter('gifmaker_render_stage_frames_total', 'Frames or images handled by each render stage')
+    return metrics
+
+
+def record_render(metrics, trace, seconds):
+    # Add one finished render and its stages to metrics
+    stages = trace.report()
+    metrics.inc('gifmaker_renders_total')
+    metrics.observe('gifmaker_render_duration_seconds', seconds)
+    metrics.observe('gifmaker_render_stage_end_rss_bytes', max((s['max_rss'] for s in stages.values()), default=0))
+    for stage, totals in stages.items():
+        metrics.inc('gifmaker_render_stage_seconds_total', totals['seconds'], stage=stage)
+        metrics.inc('gifmaker_render_stage_cpu_seconds_total', totals['cpu_seconds'], stage=stage)
+        metrics.inc('gifmaker_render_stage_frames_total', totals['frames'], stage=stage)
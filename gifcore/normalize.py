@@ -0,0 +1,99 @@
+from PIL import Image
+
+# How an image is fitted to the GIF's canvas:
+#   contain - scaled to fit inside it, with bars on two sides if needed
+#   cover   - scaled to fill it, with what overflows cropped off evenly
+#   pad     - like contain, but never scaled up, so small images get a border
+#   stretch - scaled to exactly the canvas, ignoring its aspect ratio
+FIT_MODES = ('contain', 'cover', 'pad', 'stretch')
+
+# Color of the bars and borders around images that don't fill the canvas
+BACKGROUND = (0, 0, 0)
+
+# Images are decoded and reduced to at least this multiple of their final
+# size before the last resampling filter, which keeps them as sharp as a
+# full resize
+REDUCING_GAP = 2
+
+
+class Normalizer:
+    # Brings every image of a GIF to the same canvas: the size of the first
+    # image, scaled down so neither side is over max_dimension. The work of
+    # resizing scales with the output size rather than the input size.
+    # Picklable, so it can be handed to render worker processes.
+
+    def __init__(self, max_dimension=None, fit='contain', background=BACKGROUND):
+        if fit not in FIT_MODES:
+            raise ValueError(f"Unknown fit mode: {fit}")
+        if max_dimension is not None and max_dimension < 0:
+            raise ValueError("Maximum size must be 0 or greater")
+
+        self.max_dimension = max_dimension or None
+        self.fit = fit
+        self.background = background
+
+    def canvas_size(self, size):
+        # The canvas for a GIF whose first image has the given size
+        width, height = size
+        if self.max_dimension and max(width, height) > self.max_dimension:
+            scale = self.max_dimension / max(width, height)
+            width, height = max(1, round(width * scale)), max(1, round(height * scale))
+        return width, height
+
+    def fit_size(self, size, canvas):
+        # What an image of the given size is resized to before it is put on
+        # the canvas
+        if self.fit == 'stretch':
+            return canvas
+
+        width, height = size
+        canvas_width, canvas_height = canvas
+        if self.fit == 'cover':
+            scale = max(canvas_width / width, canvas_height / height)
+        else:
+            scale = min(canvas_width / width, canvas_height / height)
+            if self.fit == 'pad':
+                scale = min(scale, 1.0)
+
+        width, height = round(width * scale), round(height * scale)
+        # Don't leave a one pixel bar or crop just from rounding
+        if abs(width - canvas_width) <= 1:
+            width = canvas_width
+        if abs(height - canvas_height) <= 1:
+            height = canvas_height
+        return max(1, width), max(1, height)
+
+    def draft(self, img, canvas):
+        # Call on a freshly opened image before it is loaded. JPEGs are then
+        # scaled down by 1/2, 1/4 or 1/8 in the DCT while they are decoded.
+        width, height = self.fit_size(img.size, canvas)
+        img.draft('RGB', (width * REDUCING_GAP, height * REDUCING_GAP))
+
+    def normalize(self, img, canvas):
+        # img as an RGB image of exactly the canvas size. May be img itself
+        # if it already is one.
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        if img.size == canvas:
+            return img
+
+        size = self.fit_size(img.size, canvas)
+        if img.size != size:
+            # A cheap integer reduce() first, then the final LANCZOS pass over
+            # the few pixels that are left
+            factor = int(min(img.width / size[0], img.height / size[1]) / REDUCING_GAP)
+            if factor > 1:
+                img = img.reduce(factor)
+            img = img.resize(size, Image.LANCZOS)
+
+        if img.size == canvas:
+            return img
+
+        left = (canvas[0] - img.width) // 2
+        top = (canvas[1] - img.height) // 2
+        if self.fit == 'cover':
+            return img.crop((-left, -top, -left + canvas[0], -top + canvas[1]))
+
+        framed = Image.new('RGB', canvas, self.background)
+        framed.paste(img, (left, top))
+        return framed
@@ -0,0 +1,306 @@
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from PIL import Image
+
+from gifcore.clips import Clip, first_frame
+from gifcore.quantize import Quantizer
+from gifcore.trace import current, span, timed, tracing
+from gifcore.transitions import DEFAULT_SCALE_QUALITY, iter_transition_frames, to_array, transition_frame_count
+
+# Bytes of rendered segments the workers may have in flight at once. More
+# segments are only handed out while their output fits, though there is
+# always at least one.
+MAX_PENDING_BYTES = 256 * 1024 * 1024
+
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+
+def get_pool(processes):
+    # One pool per process, shared by every render running in it. Workers
+    # are started from a fork server (or spawned) instead of forked from the
+    # web worker, which has threads of its own.
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is None or _pool_size != processes:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _pool = ProcessPoolExecutor(max_workers=processes, mp_context=context)
+            _pool_size = processes
+        return _pool
+
+
+def _share(img):
+    # Copy an image's pixels into a new shared memory block
+    array = to_array(img)
+    block = SharedMemory(create=True, size=array.nbytes)
+    np.ndarray(array.shape, dtype=np.uint8, buffer=block.buf)[:] = array
+    return block
+
+
+def _attach(name, shape):
+    block = SharedMemory(name=name)
+    try:
+        img = Image.fromarray(np.ndarray(shape, dtype=np.uint8, buffer=block.buf).copy())
+    finally:
+        block.close()
+    return img
+
+
+def _segment_frames(prev_img, next_img, transition_type, num_frames, overlay, quantizer, scale_quality):
+    # The image, or every frame of a clip, plus its transition into the next
+    # one, quantized. In segment mode they all share a palette built from
+    # the two images. With no quantizer the frames stay RGB.
+    next_img = first_frame(next_img)
+    palette = None
+    if quantizer is not None:
+        with span('palette'):
+            palette = quantizer.segment_palette(first_frame(prev_img), next_img)
+    last = None
+    for last in (prev_img if isinstance(prev_img, Clip) else [prev_img]):
+        frame = last
+        if quantizer is not None:
+            with span('quantize', 1):
+                frame = quantizer.quantize(last, palette)
+        yield frame
+    if next_img is None:
+        return
+
+    # A clip's transition starts from its last frame
+    transition = iter_transition_frames(last, next_img, transition_type, num_frames, overlay=overlay,
+                                        scale_quality=scale_quality)
+    for frame in timed('transition', transition):
+        if quantizer is not None:
+            with span('quantize', 1):
+                frame = quantizer.quantize(frame, palette)
+        yield frame
+
+
+def _segment_size(shape, transition_type, num_frames, overlay, quantized):
+    # Frames in the segment of a still image, the image plus its transition
+    # into the next one, and the bytes a worker writes for them
+    count = 1
+    if transition_type is not None:
+        count += transition_frame_count((shape[1], shape[0]), transition_type, num_frames, overlay)
+    return count, count * shape[0] * shape[1] * (1 if quantized else 3)
+
+
+def _render_segment(prev_name, next_name, shape, transition_type, num_frames, overlay, quantizer, scale_quality):
+    # Runs in a pool worker. Renders the image at prev_name plus its
+    # transition into next_name, quantizes every frame and writes the
+    # palette indexes (or RGB pixels, with no quantizer) into a new shared
+    # memory block for the parent to read. The block is sized up front, so
+    # each frame goes into it as soon as it is made and the worker never
+    # holds more than one. The stages it went through are sent back with it.
+    prev_img = _attach(prev_name, shape)
+    next_img = _attach(next_name, shape) if next_name is not None else None
+    if next_img is None:
+        transition_type = None
+
+    count, size = _segment_size(shape, transition_type, num_frames, overlay, quantizer is not None)
+    frame_size = size // count
+    block = SharedMemory(create=True, size=size)
+    palettes = []
+    try:
+        with tracing() as trace:
+            for frame in _segment_frames(prev_img, next_img, transition_type, num_frames, overlay, quantizer, scale_quality):
+                k = len(palettes)
+                if k == count:
+                    raise ValueError(f"Segment has more than the {count} frames expected")
+                block.buf[k * frame_size:(k + 1) * frame_size] = frame.tobytes()
+                palettes.append(bytes(frame.palette.palette) if quantizer is not None else None)
+        if len(palettes) != count:
+            raise ValueError(f"Segment has {len(palettes)} frames, {count} expected")
+    except Exception:
+        block.close()
+        block.unlink()
+        raise
+
+    block.close()
+    return block.name, palettes, trace.report()
+
+
+def _read_segment(name, palettes, stages, size):
+    # Turn a worker's output block back into palette images (RGB ones where
+    # the palette is None) and free it, adding the stages the worker traced
+    # to this thread's trace
+    trace = current()
+    if trace is not None:
+        trace.merge(stages)
+
+    block = SharedMemory(name=name)
+    rgb = bool(palettes) and palettes[0] is None
+    frame_size = size[0] * size[1] * (3 if rgb else 1)
+    try:
+        frames = []
+        for k, palette in enumerate(palettes):
+            data = bytes(block.buf[k * frame_size:(k + 1) * frame_size])
+            if rgb:
+                frames.append(Image.frombytes("RGB", size, data))
+                continue
+            frame = Image.frombytes("P", size, data)
+            frame.putpalette(palette)
+            frames.append(frame)
+        return frames
+    finally:
+        block.close()
+        block.unlink()
+
+
+def _discard(future):
+    # Free the output block of a segment that will never be read
+    if future.cancel() or future.exception() is not None:
+        return
+    block = SharedMemory(name=future.result()[0])
+    block.close()
+    block.unlink()
+
+
+def iter_segments(images, transitions, num_frames, overlay=False, processes=1, progress=None, quantizer=None, skip=(), rgb=False,
+                  scale_quality=DEFAULT_SCALE_QUALITY):
+    # Yield (index, frames) for every segment of the animation: each image
+    # followed by its transition into the next one, quantized by quantizer,
+    # or left as RGB frames for full color formats when rgb is set.
+    # scale_quality picks how Grow and Shrink resize images.
+    # images is an iterable of same sized images or clips, transitions holds
+    # the transition type between each pair and num_frames the number of
+    # frames of every transition, or a list with one for each. Segments whose
+    # index is in skip are not rendered and come out with None for frames.
+    # Images that only skipped segments use may be None, so they never have
+    # to be loaded.
+    #
+    # With more than one process the segments are rendered and quantized
+    # in parallel, with segments still coming out in order. Images are handed
+    # to the workers through shared memory, and only a couple of segments
+    # per process, and MAX_PENDING_BYTES of their frames, are in flight at
+    # once so memory stays bounded. Clips are
+    # played here rather than in a worker, decoding their frames as they go.
+    total = len(transitions) + 1
+    if not isinstance(num_frames, (list, tuple)):
+        num_frames = [num_frames] * len(transitions)
+    num_frames = list(num_frames) + [0]
+    if rgb:
+        quantizer = None
+    elif quantizer is None:
+        quantizer = Quantizer()
+    images = iter(images)
+
+    if processes <= 1:
+        img = next(images)
+        for i in range(total):
+            # A segment needs the image after it too
+            next_img = next(images) if i + 1 < total else None
+            if progress is not None:
+                progress(i, total)
+            if i in skip:
+                yield i, None
+            else:
+                transition_type = transitions[i] if i + 1 < total else None
+                yield i, _segment_frames(img, next_img, transition_type, num_frames[i], overlay, quantizer, scale_quality)
+            img = next_img
+        return
+
+    pool = get_pool(processes)
+    blocks = deque()
+    clips = deque()
+    pending = deque()
+    # Bytes each pending segment's worker writes, and their sum
+    sizes = deque()
+    pending_bytes = 0
+    shape = None
+
+    def share(img):
+        # Workers get the first frame of a clip, for the transition into it
+        nonlocal shape
+        clips.append(img if isinstance(img, Clip) else None)
+        img = first_frame(img)
+        if img is None:
+            return None
+        shape = (img.height, img.width, 3)
+        return _share(img)
+
+    try:
+        blocks.append(share(next(images)))
+
+        loaded = 1
+        for i in range(total):
+            # Keep the pool busy, loading images only as far ahead as needed
+            while len(pending) < processes * 2 and len(pending) + i < total:
+                segment = len(pending) + i
+                if segment + 1 < total and loaded <= segment + 1:
+                    blocks.append(share(next(images)))
+                    loaded += 1
+
+                if segment in skip:
+                    pending.append(None)
+                    sizes.append(0)
+                    continue
+
+                if clips[segment - i] is not None:
+                    pending.append(clips[segment - i])
+                    sizes.append(0)
+                    continue
+
+                transition_type = transitions[segment] if segment + 1 < total else None
+                size = _segment_size(shape, transition_type, num_frames[segment], overlay, quantizer is not None)[1]
+                if pending_bytes and pending_bytes + size > MAX_PENDING_BYTES:
+                    break
+
+                next_block = blocks[segment + 1 - i] if segment + 1 < total else None
+                pending.append(pool.submit(
+                    _render_segment,
+                    blocks[segment - i].name,
+                    next_block.name if next_block is not None else None,
+                    shape,
+                    transition_type,
+                    num_frames[segment],
+                    overlay,
+                    quantizer,
+                    scale_quality
+                ))
+                sizes.append(size)
+                pending_bytes += size
+
+            future = pending.popleft()
+            pending_bytes -= sizes.popleft()
+            if progress is not None:
+                progress(i, total)
+            if future is None:
+                yield i, None
+            elif isinstance(future, Clip):
+                next_img = _attach(blocks[1].name, shape) if i + 1 < total else None
+                transition_type = transitions[i] if i < len(transitions) else None
+                yield i, _segment_frames(future, next_img, transition_type, num_frames[i], overlay, quantizer, scale_quality)
+            else:
+                with span('workers'):
+                    result = future.result()
+                yield i, _read_segment(*result, (shape[1], shape[0]))
+
+            # Image i is not needed by any later segment
+            clips.popleft()
+            block = blocks.popleft()
+            if block is not None:
+                block.close()
+                block.unlink()
+    finally:
+        for future in pending:
+            if future is not None and not isinstance(future, Clip):
+                _discard(future)
+        for block in blocks:
+            if block is not None:
+                block.close()
+                block.unlink()
+
+
+def render_segments(images, transitions, num_frames, overlay=False, processes=1, progress=None, quantizer=None):
+    # Yield every frame of the animation in order
+    for _, frames in iter_segments(images, transitions, num_frames, overlay, processes, progress, quantizer):
+        yield from frames
@@ -0,0 +1,61 @@
+import os
+import uuid
+
+from PIL import Image, ImageOps
+
+PREVIEW_SIZE = (400, 400)
+
+# Decode and reduce to at least this multiple of the preview size before the
+# final resampling filter, which keeps the result as sharp as a full resize
+REDUCING_GAP = 2
+
+
+def load_thumbnail(path, max_size=PREVIEW_SIZE):
+    # Decode an image at close to preview size instead of at full size.
+    # JPEGs are scaled down by 1/2, 1/4 or 1/8 in the DCT while decoding,
+    # other formats are shrunk with a cheap integer reduce() before the
+    # final LANCZOS pass over the few pixels that are left. Photos are
+    # turned upright by their EXIF orientation.
+    with Image.open(path) as img:
+        img.draft('RGB', (max_size[0] * REDUCING_GAP, max_size[1] * REDUCING_GAP))
+        img = ImageOps.exif_transpose(img)
+
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        factor = int(max(img.width / max_size[0], img.height / max_size[1]) / REDUCING_GAP)
+        if factor > 1:
+            img = img.reduce(factor)
+
+        img.thumbnail(max_size, Image.LANCZOS, reducing_gap=None)
+        img.load()
+        return img
+
+
+class ThumbnailStore:
+    # Preview JPEGs for uploads, stored under the digest of the upload they
+    # were made from. Uploads never change, so neither do their thumbnails.
+
+    def __init__(self, root, max_size=PREVIEW_SIZE):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, digest):
+        return os.path.join(self.root, f"{digest}.jpg")
+
+    def ensure(self, digest, source_path):
+        # Make the thumbnail for an upload unless it already exists
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            return path
+
+        image = load_thumbnail(source_path, self.max_size)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            image.save(tmp_path, format="JPEG")
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
@@ -0,0 +1,89 @@
+from PIL import Image
+
+# How each frame gets its colors:
+#   frame   - every frame gets its own adaptive palette (the old behaviour)
+#   segment - one palette per image and its transition into the next one
+#   global  - one palette for the whole GIF, built once from all the images
+PALETTE_MODES = ('frame', 'segment', 'global')
+
+# Palette building algorithms. kmeans is median cut refined by a few rounds
+# of k-means clustering, octree is the fastest and roughest.
+METHODS = {
+    'mediancut': (Image.Quantize.MEDIANCUT, 0),
+    'kmeans': (Image.Quantize.MEDIANCUT, 4),
+    'octree': (Image.Quantize.FASTOCTREE, 0),
+}
+
+# Images are shrunk to about this size before their colors are sampled for
+# a shared palette
+SAMPLE_SIZE = (128, 128)
+
+
+class Quantizer:
+    # Turns RGB frames into palette frames ready for the GIF encoder.
+    # Picklable, so it can be handed to render worker processes.
+
+    def __init__(self, mode='frame', method='mediancut', dither=False, colors=256):
+        if mode not in PALETTE_MODES:
+            raise ValueError(f"Unknown palette mode: {mode}")
+        if method not in METHODS:
+            raise ValueError(f"Unknown quantizer: {method}")
+
+        self.mode = mode
+        self.method = method
+        self.dither = dither
+        self.colors = colors
+        self.palette = None
+
+    def _quantize(self, img):
+        method, kmeans = METHODS[self.method]
+        return img.quantize(self.colors, method=method, kmeans=kmeans)
+
+    def build_palette(self, images):
+        # Build one palette covering the colors of all the given images, by
+        # quantizing a strip of small copies of them laid side by side
+        samples = []
+        for img in images:
+            sample = img.convert('RGB') if img.mode != 'RGB' else img.copy()
+            sample.thumbnail(SAMPLE_SIZE, Image.BILINEAR)
+            samples.append(sample)
+
+        if not samples:
+            return None
+
+        strip = Image.new('RGB', (sum(s.width for s in samples), max(s.height for s in samples)))
+        x = 0
+        for sample in samples:
+            strip.paste(sample, (x, 0))
+            x += sample.width
+        return self._quantize(strip)
+
+    def use_global_palette(self, images):
+        # Build the palette for global mode. Nothing to do for other modes.
+        if self.mode == 'global':
+            self.palette = self.build_palette(images)
+
+    def segment_palette(self, prev_img, next_img=None):
+        # The palette shared by one image and its transition, if any
+        if self.mode == 'global':
+            return self.palette
+        if self.mode == 'segment':
+            images = [prev_img] if next_img is None else [prev_img, next_img]
+            return self.build_palette(images)
+        return None
+
+    def quantize(self, frame, palette=None):
+        if frame.mode == 'P':
+            return frame
+        if frame.mode != 'RGB':
+            frame = frame.convert('RGB')
+
+        if palette is None:
+            if not self.dither:
+                return self._quantize(frame)
+            palette = self._quantize(frame)
+
+        # Map onto a palette we already have, which is much cheaper than
+        # building a new one
+        dither = Image.Dither.FLOYDSTEINBERG if self.dither else Image.Dither.NONE
+        return frame.quantize(palette=palette, dither=dither)
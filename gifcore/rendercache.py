@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import threading
+
+# Bump whenever a change to the renderer changes its output, so GIFs cached
+# by older code are not served for new requests
+RENDER_VERSION = 3
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def content_digest(path):
+    # SHA-256 of a file. Uploads are already stored under theirs.
+    name = os.path.basename(path)
+    if len(name) == 64 and all(c in '0123456789abcdef' for c in name):
+        return name
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def render_key(image_paths, **params):
+    # Hash of everything that decides what a render produces: the content of
+    # the images, in order, and every parameter. Two requests with the same
+    # key always produce the same GIF.
+    description = {
+        'version': RENDER_VERSION,
+        'images': [content_digest(path) for path in image_paths],
+        'params': params,
+    }
+    canonical = json.dumps(description, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class SingleFlight:
+    # Runs fn once per key at a time. Callers that ask for a key while it is
+    # already being worked on wait for that call and share its result, or
+    # its exception.
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+            return call['result']
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
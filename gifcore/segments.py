@@ -0,0 +1,287 @@
+import hashlib
+import json
+import os
+import struct
+import uuid
+import zlib
+
+from PIL import Image
+
+from gifcore.encoder import GifStreamWriter
+from gifcore.rendercache import RENDER_VERSION
+from gifcore.trace import span
+
+
+class _Buffer:
+    # File object that keeps everything written to it until take()
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _pack(data, frame_count, previous, global_table):
+    # One cache entry: the encoded frames of a segment, plus its last frame
+    # and the global color table so a writer can carry on after them
+    pixels = zlib.compress(previous.tobytes(), 1)
+    palette = bytes(previous.palette.palette)
+    header = json.dumps({
+        'frames': frame_count,
+        'size': previous.size,
+        'lengths': [len(data), len(pixels), len(palette), len(global_table)],
+    }).encode('utf-8')
+    return struct.pack("<I", len(header)) + header + data + pixels + palette + global_table
+
+
+def _unpack(blob):
+    header_length = struct.unpack_from("<I", blob)[0]
+    header = json.loads(blob[4:4 + header_length])
+
+    parts = []
+    offset = 4 + header_length
+    for length in header['lengths']:
+        parts.append(blob[offset:offset + length])
+        offset += length
+    data, pixels, palette, global_table = parts
+
+    previous = Image.frombytes("P", tuple(header['size']), zlib.decompress(pixels))
+    previous.putpalette(palette)
+    return data, header['frames'], previous, global_table
+
+
+class SegmentCache:
+    # Encoded GIF frames of rendered segments on disk, one file per segment
+    # key. Files are bumped when used, and trim() drops the least recently
+    # used ones once they take more than max_bytes.
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.root, f"{key}.seg")
+
+    def has(self, key):
+        # Also bumps the segment, so trim() leaves it alone while the render
+        # that is about to use it runs
+        try:
+            os.utime(self.path_for(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def get(self, key):
+        # (data, frame_count, previous, global_table), or None
+        path = self.path_for(key)
+        try:
+            with open(path, 'rb') as f:
+                blob = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return _unpack(blob)
+
+    def put(self, key, data, frame_count, previous, global_table):
+        path = self.path_for(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(_pack(data, frame_count, previous, global_table))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def trim(self, keep_after=None):
+        # Returns the number of segments removed and the bytes freed.
+        # Segments used after keep_after are kept whatever the size, a render
+        # may be about to splice them in.
+        entries = []
+        with os.scandir(self.root) as scan:
+            for entry in scan:
+                if not entry.name.endswith('.seg'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        removed = freed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if keep_after is not None and mtime > keep_after:
+                break
+            total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += size
+        return removed, freed
+
+
+def _hash(*parts):
+    canonical = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _timed(frames, durations, i):
+    # (frame, duration) for every frame of segment i. Without durations
+    # every frame gets None, for the stream's duration. With them there
+    # must be exactly one for each frame.
+    if durations is None:
+        for frame in frames:
+            yield frame, None
+        return
+
+    count = 0
+    for frame in frames:
+        if count == len(durations):
+            raise ValueError(f"Segment {i} has more frames than its {len(durations)} durations")
+        yield frame, durations[count]
+        count += 1
+    if count != len(durations):
+        raise ValueError(f"Segment {i} has {count} frames but {len(durations)} durations")
+
+
+def segment_keys(digests, transitions, num_frames, palette_mode, durations=None, **params):
+    # A key for each segment of a render, given the content digest of every
+    # image. The bytes of a segment depend on its own images and transition,
+    # on the last frame of the segment before it (which it is encoded as
+    # changes to) and on the global color table taken from the first frame,
+    # so all of those go into its key along with every render setting.
+    # Changing one transition only changes the keys of two segments. With a
+    # timeline, durations holds the frame durations of every segment, which
+    # go into its key too.
+    if palette_mode == 'global':
+        palette_images = digests
+    elif palette_mode == 'segment':
+        palette_images = digests[:2]
+    else:
+        palette_images = digests[:1]
+    base = _hash(RENDER_VERSION, palette_images, num_frames, palette_mode, params)
+
+    def segment(i):
+        # The images and transition a segment is rendered from
+        if i + 1 < len(digests):
+            parts = [digests[i], transitions[i], digests[i + 1]]
+        else:
+            parts = [digests[i]]
+        if durations is not None:
+            parts.append(durations[i])
+        return parts
+
+    return [
+        _hash(base, segment(i - 1) if i > 0 else None, segment(i))
+        for i in range(len(digests))
+    ]
+
+
+class SegmentStream:
+    # The bytes of a GIF made from (index, frames) segments, as made by
+    # iter_segments. Iterating yields them as soon as each frame is encoded,
+    # so they can be sent on before the rest is rendered. Segments found in
+    # the cache are spliced in as they were encoded before, the others are
+    # encoded and added to the cache. Segments that come with no frames must
+    # be in the cache. Frames last duration each, or when durations is given,
+    # as long as its list for their segment says.
+
+    def __init__(self, segments, keys, cache, duration=100, loop=0, quantizer=None, durations=None):
+        self.segments = segments
+        self.keys = keys
+        self.cache = cache
+        self.duration = duration
+        self.loop = loop
+        self.quantizer = quantizer
+        self.durations = durations
+        self.frame_count = 0
+
+    def __iter__(self):
+        buffer = _Buffer()
+        writer = GifStreamWriter(buffer, duration=self.duration, loop=self.loop, quantizer=self.quantizer)
+        for i, frames in self.segments:
+            if frames is None:
+                with span('splice'):
+                    cached = self.cache.get(self.keys[i])
+                    if cached is None:
+                        raise ValueError(f"Segment {i} is no longer cached")
+                    writer.splice(*cached)
+                self.frame_count = writer.frame_count
+                yield buffer.take()
+                continue
+
+            start = writer.frame_count
+            encoded = []
+            durations = self.durations[i] if self.durations is not None else None
+            for frame, duration in _timed(frames, durations, i):
+                with span('encode', 1):
+                    writer.write(frame, duration)
+                data = buffer.take()
+                if data:
+                    encoded.append(data)
+                    yield data
+            with span('encode'):
+                writer.flush()
+            encoded.append(buffer.take())
+            yield encoded[-1]
+
+            previous, global_table = writer.checkpoint()
+            self.cache.put(self.keys[i], b"".join(encoded), writer.frame_count - start, previous, global_table)
+            self.frame_count = writer.frame_count
+
+        if writer.frame_count == 0:
+            raise ValueError("No frames to write")
+        writer.close()
+        self.frame_count = writer.frame_count
+        yield buffer.take()
+
+
+class AnimationStream:
+    # The bytes of an animation made from (index, frames) segments, in any
+    # OutputFormat, without the segment cache. Bytes are yielded as the
+    # writer makes them: as each frame is encoded for GIF, all at the end for
+    # WebP and APNG, whose headers need the frame count.
+
+    def __init__(self, segments, output_format, duration=100, loop=0, quantizer=None, durations=None):
+        self.segments = segments
+        self.output_format = output_format
+        self.duration = duration
+        self.loop = loop
+        self.quantizer = quantizer
+        self.durations = durations
+        self.frame_count = 0
+
+    def __iter__(self):
+        buffer = _Buffer()
+        with self.output_format.writer(buffer, self.duration, self.loop, self.quantizer) as writer:
+            for i, frames in self.segments:
+                durations = self.durations[i] if self.durations is not None else None
+                for frame, duration in _timed(frames, durations, i):
+                    with span('encode', 1):
+                        writer.write(frame, duration)
+                    data = buffer.take()
+                    if data:
+                        yield data
+                self.frame_count = writer.frame_count
+
+            with span('encode'):
+                writer.flush()
+                if writer.frame_count == 0:
+                    raise ValueError("No frames to write")
+                writer.close()
+        self.frame_count = writer.frame_count
+        yield buffer.take()
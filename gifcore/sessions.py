@@ -0,0 +1,312 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+
+
+class MemorySessionStore:
+    # Sessions kept in a dict in this process. Fine for a single worker, but
+    # every worker process gets its own copy.
+
+    def __init__(self):
+        self._sessions = {}
+        self._updated = {}
+        self._lock = threading.Lock()
+
+    def ensure(self, session_id=None):
+        # Use the given session, creating it (or a new one) if needed
+        if not session_id:
+            session_id = uuid.uuid4().hex
+        with self._lock:
+            if session_id not in self._sessions:
+                self._sessions[session_id] = {'images': [], 'animations': [], 'options': []}
+                self._updated[session_id] = time.time()
+        return session_id
+
+    def exists(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def get(self, session_id):
+        # A copy of the session's images, their animations and options, or
+        # None. Reading a session counts as using it, so one that is only
+        # being rendered doesn't expire.
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            self._updated[session_id] = time.time()
+            return {
+                'images': list(session['images']),
+                'animations': list(session['animations']),
+                'options': [dict(options) for options in session['options']],
+            }
+
+    def append_image(self, session_id, path, animation="None", options=None):
+        # Add an image to the end of the session and return its index.
+        # options is a dict of settings for this image, like how to play it
+        # as a clip.
+        with self._lock:
+            session = self._sessions.setdefault(session_id, {'images': [], 'animations': [], 'options': []})
+            session['images'].append(path)
+            session['animations'].append(animation)
+            session['options'].append(dict(options or {}))
+            self._updated[session_id] = time.time()
+            return len(session['images']) - 1
+
+    def remove_image(self, session_id, index):
+        # Returns False if there is no image at index
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or not 0 <= index < len(session['images']):
+                return False
+            del session['images'][index]
+            del session['animations'][index]
+            del session['options'][index]
+            self._updated[session_id] = time.time()
+            return True
+
+    def set_animation(self, session_id, index, animation):
+        # Returns False if there is no image at index
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or not 0 <= index < len(session['images']):
+                return False
+            session['animations'][index] = animation
+            self._updated[session_id] = time.time()
+            return True
+
+    def update_options(self, session_id, index, changes):
+        # Merge changes into the options of the image at index, dropping the
+        # ones set to None. Returns False if there is no image at index.
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or not 0 <= index < len(session['images']):
+                return False
+            options = session['options'][index]
+            options.update(changes)
+            session['options'][index] = {key: value for key, value in options.items() if value is not None}
+            self._updated[session_id] = time.time()
+            return True
+
+    def set_all_animations(self, session_id, animation):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return False
+            session['animations'] = [animation] * len(session['images'])
+            self._updated[session_id] = time.time()
+            return True
+
+    def count(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def expire(self, cutoff):
+        # Drop the sessions last used before cutoff and return how many
+        with self._lock:
+            expired = [session_id for session_id, updated in self._updated.items() if updated < cutoff]
+            for session_id in expired:
+                del self._sessions[session_id]
+                del self._updated[session_id]
+            return len(expired)
+
+    def image_refcounts(self):
+        # How many times each image path is used across all sessions
+        with self._lock:
+            return Counter(path for session in self._sessions.values() for path in session['images'])
+
+
+class SQLiteSessionStore:
+    # Sessions kept in a SQLite database in WAL mode, so every worker process
+    # on the machine sees the same sessions. Each image is a row, ordered by
+    # rowid, and every change is a single statement or an immediate
+    # transaction, so concurrent requests can't interleave half way through.
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_images ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "session_id TEXT NOT NULL REFERENCES sessions(id) ON DELETE CASCADE, "
+            "path TEXT NOT NULL, animation TEXT, options TEXT)"
+        )
+        # Databases made before images had options
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(session_images)")]
+        if 'options' not in columns:
+            conn.execute("ALTER TABLE session_images ADD COLUMN options TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS session_images_session ON session_images (session_id, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+
+    def _connect(self):
+        # One connection per thread, reopened in forked worker processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self, work):
+        # Run work(conn) in a write transaction, taking the lock up front so
+        # reads inside it can't go stale
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    def _touch(self, conn, session_id):
+        return conn.execute("UPDATE sessions SET updated = ? WHERE id = ?", (time.time(), session_id)).rowcount > 0
+
+    def ensure(self, session_id=None):
+        if not session_id:
+            session_id = uuid.uuid4().hex
+        now = time.time()
+        self._connect().execute(
+            "INSERT OR IGNORE INTO sessions (id, created, updated) VALUES (?, ?, ?)",
+            (session_id, now, now)
+        )
+        return session_id
+
+    def exists(self, session_id):
+        row = self._connect().execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return row is not None
+
+    def get(self, session_id):
+        # Reading a session counts as using it, so one that is only being
+        # rendered doesn't expire. Both tables are then read from the same
+        # snapshot.
+        conn = self._connect()
+        if not self._touch(conn, session_id):
+            return None
+        conn.execute("BEGIN")
+        try:
+            if conn.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is None:
+                return None
+            rows = conn.execute(
+                "SELECT path, animation, options FROM session_images WHERE session_id = ? ORDER BY id",
+                (session_id,)
+            ).fetchall()
+        finally:
+            conn.execute("COMMIT")
+        return {
+            'images': [row[0] for row in rows],
+            'animations': [row[1] for row in rows],
+            'options': [json.loads(row[2]) if row[2] else {} for row in rows],
+        }
+
+    def append_image(self, session_id, path, animation="None", options=None):
+        def append(conn):
+            now = time.time()
+            conn.execute(
+                "INSERT INTO sessions (id, created, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET updated = excluded.updated",
+                (session_id, now, now)
+            )
+            conn.execute(
+                "INSERT INTO session_images (session_id, path, animation, options) VALUES (?, ?, ?, ?)",
+                (session_id, path, animation, json.dumps(options) if options else None)
+            )
+            return conn.execute("SELECT COUNT(*) FROM session_images WHERE session_id = ?", (session_id,)).fetchone()[0] - 1
+
+        return self._transaction(append)
+
+    def _image_row(self, conn, session_id, index):
+        # Rowid of the image at index in the session, or None
+        if index < 0:
+            return None
+        row = conn.execute(
+            "SELECT id FROM session_images WHERE session_id = ? ORDER BY id LIMIT 1 OFFSET ?",
+            (session_id, index)
+        ).fetchone()
+        return row[0] if row else None
+
+    def remove_image(self, session_id, index):
+        def remove(conn):
+            row_id = self._image_row(conn, session_id, index)
+            if row_id is None:
+                return False
+            conn.execute("DELETE FROM session_images WHERE id = ?", (row_id,))
+            self._touch(conn, session_id)
+            return True
+
+        return self._transaction(remove)
+
+    def set_animation(self, session_id, index, animation):
+        def update(conn):
+            row_id = self._image_row(conn, session_id, index)
+            if row_id is None:
+                return False
+            conn.execute("UPDATE session_images SET animation = ? WHERE id = ?", (animation, row_id))
+            self._touch(conn, session_id)
+            return True
+
+        return self._transaction(update)
+
+    def update_options(self, session_id, index, changes):
+        def update(conn):
+            row_id = self._image_row(conn, session_id, index)
+            if row_id is None:
+                return False
+            row = conn.execute("SELECT options FROM session_images WHERE id = ?", (row_id,)).fetchone()
+            options = json.loads(row[0]) if row[0] else {}
+            options.update(changes)
+            options = {key: value for key, value in options.items() if value is not None}
+            conn.execute("UPDATE session_images SET options = ? WHERE id = ?", (json.dumps(options) if options else None, row_id))
+            self._touch(conn, session_id)
+            return True
+
+        return self._transaction(update)
+
+    def set_all_animations(self, session_id, animation):
+        def update(conn):
+            if not self._touch(conn, session_id):
+                return False
+            conn.execute("UPDATE session_images SET animation = ? WHERE session_id = ?", (animation, session_id))
+            return True
+
+        return self._transaction(update)
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def expire(self, cutoff):
+        # Their images go with them through the foreign key
+        return self._transaction(
+            lambda conn: conn.execute("DELETE FROM sessions WHERE updated < ?", (cutoff,)).rowcount
+        )
+
+    def image_refcounts(self):
+        rows = self._connect().execute("SELECT path, COUNT(*) FROM session_images GROUP BY path")
+        return Counter(dict(rows.fetchall()))
+
+
+def open_session_store(backend, path=None):
+    # backend is 'memory' or 'sqlite'. path is the database file for sqlite.
+    if backend == 'memory':
+        return MemorySessionStore()
+    if backend == 'sqlite':
+        return SQLiteSessionStore(path)
+    raise ValueError(f"Unknown session store: {backend}")
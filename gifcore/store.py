@@ -0,0 +1,296 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import uuid
+from collections import OrderedDict
+
+from PIL import ExifTags, Image, ImageOps
+
+from gifcore.normalize import Normalizer
+from gifcore.trace import span
+
+CHUNK_SIZE = 1024 * 1024
+
+# Raw image files start with this header: a magic number, the size of the
+# pixels that follow and the size of the upright source image they were
+# made from. The pixels are packed RGB rows.
+RAW_MAGIC = b"GMRAW1\0\0"
+RAW_HEADER = struct.Struct("<8sIIII")
+
+# EXIF orientations that turn the image on its side
+_SIDEWAYS = (5, 6, 7, 8)
+
+
+class BlobStore:
+    # Stores uploaded files under the SHA-256 of their content, so the same
+    # image uploaded twice is only kept once and two uploads that happen to
+    # share a filename never overwrite each other
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest)
+
+    def put_stream(self, stream):
+        # Copy a file-like object into the store. Returns (digest, path).
+        return self.put_chunks(iter(lambda: stream.read(CHUNK_SIZE), b''))
+
+    def put_chunks(self, chunks):
+        # Write an iterable of byte chunks into the store, hashing them on
+        # the way. If the iterable raises, nothing is stored.
+        tmp_path = os.path.join(self.root, f".upload_{uuid.uuid4().hex}.tmp")
+        sha = hashlib.sha256()
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    f.write(chunk)
+            return self._commit(tmp_path, sha.hexdigest())
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def put_bytes(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            _refresh(path)
+            return digest, path
+
+        tmp_path = os.path.join(self.root, f".upload_{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        return self._commit(tmp_path, digest)
+
+    def _commit(self, tmp_path, digest):
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            # Already stored by an earlier upload
+            os.remove(tmp_path)
+            _refresh(path)
+        else:
+            os.replace(tmp_path, path)
+        return digest, path
+
+    def blobs(self):
+        # (digest, path, size, mtime) for every stored file
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.name, entry.path, stat.st_size, stat.st_mtime
+
+
+def _refresh(path):
+    # Mark a stored file as just stored again, so the janitor's grace period
+    # starts over for uploads that were deduplicated against it
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def image_nbytes(img):
+    return img.width * img.height * len(img.getbands())
+
+
+class ImageCache:
+    # LRU cache of decoded images, bounded by the bytes their pixels take
+    # up. Cached images are shared between renders and must not be modified.
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            img = self._entries.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return img
+
+    def put(self, key, img):
+        nbytes = image_nbytes(img)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= image_nbytes(old)
+
+            self._entries[key] = img
+            self.current_bytes += nbytes
+
+            # Evict the least recently used images until we fit again
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= image_nbytes(evicted)
+
+    def get_or_load(self, key, loader):
+        img = self.get(key)
+        if img is None:
+            img = loader()
+            self.put(key, img)
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+def _orientation(img):
+    return img.getexif().get(ExifTags.Base.Orientation, 1)
+
+
+def _sideways(img):
+    return _orientation(img) in _SIDEWAYS
+
+
+def _decode(img):
+    # A loaded image turned upright by its EXIF orientation, as a new RGB
+    # image
+    if _orientation(img) != 1:
+        img = ImageOps.exif_transpose(img)
+        return img.convert('RGB') if img.mode != 'RGB' else img
+    return img.convert('RGB') if img.mode != 'RGB' else img.copy()
+
+
+def upright_size(path):
+    # Size of an image once turned upright, read from its header
+    with Image.open(path) as img:
+        return img.size[::-1] if _sideways(img) else img.size
+
+
+def load_image(path, size=None, normalizer=None):
+    # Decode an image fully into memory as upright RGB, fitted to the given
+    # canvas size by normalizer (stretched to it by default)
+    if normalizer is None:
+        normalizer = Normalizer(fit='stretch')
+
+    with Image.open(path) as img:
+        if size is not None:
+            # The draft is taken before the image is turned upright
+            normalizer.draft(img, size[::-1] if _sideways(img) else size)
+        with span('open', 1):
+            img.load()
+            img = _decode(img)
+        if size is None or img.size == size:
+            return img
+        with span('resize', 1):
+            return normalizer.normalize(img, size)
+
+
+class RawImageStore:
+    # Uploads decoded once, when they arrive: turned upright, converted to
+    # RGB, scaled down so neither side is over max_dimension and written out
+    # as raw pixels under the upload's digest. Renders map these files
+    # instead of decoding the JPEG or PNG again, and since the pages are
+    # shared every worker process reads them from the same page cache.
+
+    def __init__(self, root, max_dimension=None):
+        self.root = root
+        self.max_dimension = max_dimension or None
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, digest):
+        return os.path.join(self.root, f"{digest}.raw")
+
+    def ensure(self, digest, source_path):
+        # Decode an upload unless that was already done. Returns the path.
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            return path
+
+        with span('ingest', 1):
+            source_size = upright_size(source_path)
+            size = Normalizer(self.max_dimension).canvas_size(source_size)
+            img = load_image(source_path, size)
+
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(RAW_HEADER.pack(RAW_MAGIC, *size, *source_size))
+                    f.write(img.tobytes())
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return path
+
+    def source_size(self, digest, source_path):
+        # Size of the upload once turned upright, without decoding it
+        with open(self.ensure(digest, source_path), 'rb') as f:
+            return _read_header(f.read(RAW_HEADER.size), f.name)[1]
+
+    def open(self, digest, source_path):
+        # The decoded upload as an RGB image, copied straight out of the
+        # mapped file. Pillow keeps RGB at four bytes a pixel, so it can't
+        # use the packed rows in place, but this is one pass over memory
+        # instead of a decode.
+        return self._map(self.ensure(digest, source_path))[0]
+
+    def _map(self, path):
+        # (image, source_size)
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            size, source_size = _read_header(mapped[:RAW_HEADER.size], path)
+            view = memoryview(mapped)[RAW_HEADER.size:]
+            try:
+                return Image.frombuffer('RGB', size, view, 'raw', 'RGB', 0, 1), source_size
+            finally:
+                view.release()
+
+    def load(self, digest, source_path, size=None, normalizer=None):
+        # Like load_image, but from the decoded upload. Only falls back to
+        # decoding the source if the canvas needs more pixels than were kept.
+        if normalizer is None:
+            normalizer = Normalizer(fit='stretch')
+
+        path = self.ensure(digest, source_path)
+        with span('open', 1):
+            img, source_size = self._map(path)
+        if size is None or img.size == size:
+            return img
+
+        width, height = normalizer.fit_size(img.size, size)
+        if (width > img.width or height > img.height) and img.size != source_size:
+            return load_image(source_path, size, normalizer)
+        with span('resize', 1):
+            return normalizer.normalize(img, size)
+
+    def files(self):
+        # (path, size) for every decoded upload
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.raw'):
+                    continue
+                try:
+                    yield entry.path, entry.stat().st_size
+                except FileNotFoundError:
+                    continue
+
+
+def _read_header(data, path):
+    # (size, source_size) from the start of a raw image file
+    if len(data) < RAW_HEADER.size:
+        raise ValueError(f"Truncated raw image: {path}")
+    magic, width, height, source_width, source_height = RAW_HEADER.unpack(data)
+    if magic != RAW_MAGIC:
+        raise ValueError(f"Not a raw image: {path}")
+    return (width, height), (source_width, source_height)
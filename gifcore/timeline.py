@@ -0,0 +1,67 @@
+# GIF frame delays are counted in hundredths of a second, so every duration
+# is a multiple of this many milliseconds
+TICK = 10
+
+# Browsers show GIF frames shorter than 20ms for 100ms instead, so frame
+# rates above 50 would play slower rather than smoother
+MAX_FPS = 50
+
+
+def spread(total, count):
+    # count frame durations that add up to total (to the nearest tick), as
+    # evenly as ticks allow
+    ends = [round(total * k / count / TICK) * TICK for k in range(count + 1)]
+    return [end - start for start, end in zip(ends, ends[1:])]
+
+
+class Timeline:
+    # When each frame of a render is shown, as times rather than frame
+    # counts: every still image is held for holds[i] milliseconds, and the
+    # transition after it lasts transition_times[i]. Transitions get as many
+    # frames as fps needs for their time, each shown for an even share of
+    # it, and clips play their frames at fps. A long hold is still a single
+    # frame, so a render has far fewer frames than with one duration for
+    # every frame.
+
+    def __init__(self, holds, transition_times, fps, image_frames=None):
+        if not 0 < fps <= MAX_FPS:
+            raise ValueError(f"Frame rate must be greater than 0 and at most {MAX_FPS}")
+        if any(hold <= 0 for hold in holds):
+            raise ValueError("Hold times must be greater than 0")
+        if any(time < 0 for time in transition_times):
+            raise ValueError("Transition times must be 0 or greater")
+        if len(transition_times) != max(0, len(holds) - 1):
+            raise ValueError("There must be one transition time between each pair of images")
+
+        self.holds = [max(TICK, round(hold / TICK) * TICK) for hold in holds]
+        self.transition_times = list(transition_times)
+        self.fps = fps
+        # How many frames each image plays, more than one for a clip
+        self.image_frames = list(image_frames) if image_frames is not None else [1] * len(holds)
+
+    def transition_frames(self):
+        # Number of frames each transition is rendered with
+        return [round(time * self.fps / 1000) for time in self.transition_times]
+
+    def segment_durations(self, i, transition_frames=None):
+        # Durations of the frames of segment i: the image, or every frame of
+        # a clip, then the frames of its transition into the next image.
+        # transition_frames is how many frames the transition is actually
+        # rendered with, when some of them are skipped.
+        count = self.image_frames[i]
+        if count > 1:
+            durations = spread(count * 1000 / self.fps, count)
+        else:
+            durations = [self.holds[i]]
+
+        if i < len(self.transition_times):
+            frames = round(self.transition_times[i] * self.fps / 1000)
+            if transition_frames is not None:
+                frames = transition_frames
+            if frames:
+                durations.extend(spread(self.transition_times[i], frames))
+        return durations
+
+    def settings(self):
+        # Everything that changes the output, for render keys
+        return {'fps': self.fps, 'holds': self.holds, 'transition_times': self.transition_times}
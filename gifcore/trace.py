@@ -0,0 +1,124 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+try:
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+
+def _rss():
+    # Resident memory of this process in bytes, or 0 where it can't be read
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class Trace:
+    # What one render spent in each of its stages: wall time, CPU time, the
+    # frames or images handled and the highest resident memory seen at the
+    # end of a span. Spans are recorded on the thread that runs them, see
+    # tracing().
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds=0.0, cpu_seconds=0.0, frames=0, max_rss=0):
+        with self._lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                totals = self.stages[stage] = {'seconds': 0.0, 'cpu_seconds': 0.0, 'frames': 0, 'max_rss': 0}
+            totals['seconds'] += seconds
+            totals['cpu_seconds'] += cpu_seconds
+            totals['frames'] += frames
+            totals['max_rss'] = max(totals['max_rss'], max_rss)
+
+    def merge(self, stages):
+        # Add stages recorded somewhere else, like a render worker process
+        for stage, totals in stages.items():
+            self.add(stage, **totals)
+
+    def report(self):
+        with self._lock:
+            return {
+                stage: {
+                    'seconds': round(totals['seconds'], 4),
+                    'cpu_seconds': round(totals['cpu_seconds'], 4),
+                    'frames': totals['frames'],
+                    'max_rss': totals['max_rss'],
+                }
+                for stage, totals in self.stages.items()
+            }
+
+
+def current():
+    # The trace spans on this thread go to, or None
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def tracing(trace=None):
+    # Record the spans run on this thread inside the block into trace, or a
+    # new Trace, which is what the block gets
+    if trace is None:
+        trace = Trace()
+    previous = current()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def traced(trace, iterable):
+    # Iterate while recording into trace, for generators that do their work
+    # outside of the block that started them, like a streamed response
+    iterator = iter(iterable)
+    while True:
+        with tracing(trace):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+@contextmanager
+def span(stage, frames=0):
+    # Count the time spent in the block against stage. Costs next to nothing
+    # when nothing is being traced.
+    trace = current()
+    if trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        trace.add(stage, time.perf_counter() - start, time.thread_time() - cpu_start, frames, _rss())
+
+
+def timed(stage, iterable):
+    # Yield the items of iterable, counting the time taken to make each one
+    # against stage
+    iterator = iter(iterable)
+    while True:
+        trace = current()
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        if trace is not None:
+            trace.add(stage, time.perf_counter() - start, time.thread_time() - cpu_start, 1, _rss())
+        yield item
@@ -1,3 +1,14 @@
-workers = 4
+import os
+
+# Each worker process serves requests on a pool of threads, so requests
+# that spend their time waiting on the network or disk (fetching images,
+# uploads, downloads, polling jobs) don't hold up a whole worker. Renders
+# run on the job queue's threads and the render process pool, not on the
+# request threads.
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+# The app splits the cores between the workers' render process pools by this
+os.environ['WEB_CONCURRENCY'] = str(workers)
+worker_class = os.environ.get('WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('WEB_THREADS', 64))
 bind = "0.0.0.0:10000"
-timeout = 120 
\ No newline at end of file
+timeout = 30
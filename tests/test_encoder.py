@@ -0,0 +1,33 @@
+import io
+
+from PIL import Image, ImageSequence
+
+from gifcore.encoder import MAX_DELAY, GifStreamWriter
+
+
+def _durations(data):
+    with Image.open(io.BytesIO(data)) as gif:
+        return [frame.info['duration'] for frame in ImageSequence.Iterator(gif)]
+
+
+def _write(frames):
+    fp = io.BytesIO()
+    with GifStreamWriter(fp) as writer:
+        for frame, duration in frames:
+            writer.write(frame, duration)
+    return fp.getvalue()
+
+
+def test_merged_duplicates_stay_within_the_longest_delay():
+    # 7000 identical 100 ms frames add up to more than one frame can show
+    frame = Image.new('RGB', (4, 4), (200, 10, 10))
+    durations = _durations(_write([(frame, 100)] * 7000))
+    assert len(durations) == 2 and max(durations) <= MAX_DELAY
+    assert sum(durations) == 700000
+
+
+def test_long_delays_are_split():
+    first = Image.new('RGB', (4, 4), (200, 10, 10))
+    second = Image.new('RGB', (4, 4), (10, 10, 200))
+    durations = _durations(_write([(first, 100), (second, 2 * MAX_DELAY + 500), (first, 100)]))
+    assert durations == [100, MAX_DELAY, MAX_DELAY, 500, 100]
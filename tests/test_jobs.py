@@ -0,0 +1,47 @@
+import threading
+import time
+
+from gifcore import jobs
+from gifcore.jobs import JobQueue
+
+
+def test_long_running_jobs_stay_live(tmp_path, monkeypatch):
+    # A job that renders for longer than STALE_AFTER without reporting
+    # progress is kept alive by the heartbeat, so it isn't run again
+    monkeypatch.setattr(jobs, 'STALE_AFTER', 0.5)
+    monkeypatch.setattr(jobs, 'HEARTBEAT_INTERVAL', 0.1)
+    queue = JobQueue(str(tmp_path), workers=1)
+    release = threading.Event()
+    runs = []
+
+    def render(progress):
+        runs.append(1)
+        release.wait()
+        return {}
+
+    job_id = queue.submit_once('a' * 32, render)
+    try:
+        time.sleep(1.5)
+        assert queue.submit_once(job_id, render) == job_id
+        assert queue.get(job_id)['status'] == 'running'
+    finally:
+        release.set()
+    while queue.get(job_id)['status'] != 'done':
+        time.sleep(0.05)
+    assert len(runs) == 1
+
+
+def test_abandoned_jobs_are_run_again(tmp_path, monkeypatch):
+    # Nothing touches the state of a job whose worker died, so it goes stale
+    monkeypatch.setattr(jobs, 'STALE_AFTER', 0.2)
+    first = JobQueue(str(tmp_path))
+    job = first._new_job('b' * 32)
+    first._write_state(job)
+    assert first._live(job['id'])
+    time.sleep(0.3)
+
+    second = JobQueue(str(tmp_path))
+    second.submit_once(job['id'], lambda progress: {'ok': True})
+    while second.get(job['id'])['status'] != 'done':
+        time.sleep(0.05)
+    assert second.get(job['id'])['result'] == {'ok': True}
@@ -0,0 +1,39 @@
+import io
+
+import pytest
+from PIL import Image, ImageSequence
+
+from gifcore.formats import OutputFormat
+from gifcore.segments import AnimationStream
+from gifcore.timeline import Timeline
+from gifcore.transitions import transition_frame_count
+
+
+def _frames(count, seed):
+    return [Image.new('RGB', (8, 6), (seed * 40 % 256, k * 30 % 256, 0)) for k in range(count)]
+
+
+def test_pushed_grow_spreads_its_time_over_the_frames_it_makes():
+    # A pushed Grow skips its empty first frame, so its time is shared by
+    # one frame fewer than the frame rate asks for
+    timeline = Timeline([500, 500], [300], 20)
+    planned = timeline.transition_frames()[0]
+    rendered = transition_frame_count((8, 6), "Grow", planned)
+    assert rendered == planned - 1
+
+    durations = timeline.segment_durations(0, rendered)
+    assert durations[0] == 500
+    assert len(durations) == 1 + rendered and sum(durations[1:]) == 300
+
+
+def test_durations_must_match_the_frames():
+    segments = [(0, _frames(3, 0)), (1, _frames(1, 1))]
+    stream = AnimationStream(iter(segments), OutputFormat('gif'), durations=[[100, 20, 20], [500]])
+    data = b"".join(stream)
+    with Image.open(io.BytesIO(data)) as gif:
+        assert [frame.info['duration'] for frame in ImageSequence.Iterator(gif)] == [100, 20, 20, 500]
+
+    for durations in ([[100, 20], [500]], [[100, 20, 20, 20], [500]]):
+        stream = AnimationStream(iter([(0, _frames(3, 0))]), OutputFormat('gif'), durations=durations)
+        with pytest.raises(ValueError):
+            b"".join(stream)
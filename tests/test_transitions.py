@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from gifcore.transitions import TRANSITION_TYPES, Transition, iter_transition_frames, transition_frame_count
+
+# The frames must match, pixel for pixel, the per-frame Image.blend and
+# Image.paste code the transitions replaced, for push (app.py) and overlay
+# (api/app.py and the desktop app) transitions alike.
+
+NUM_FRAMES = (1, 7, 15)
+SIZES = ((37, 23), (64, 48))
+
+
+def _image(size, seed):
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8))
+
+
+def _push_frames(prev_img, next_img, transition_type, num_frames):
+    # The old push transitions of app.py
+    width, height = prev_img.size
+    for i in range(num_frames):
+        if transition_type == "Fade in":
+            yield Image.blend(prev_img, next_img, i / num_frames)
+            continue
+
+        if transition_type in ("Grow", "Shrink"):
+            background, source = (prev_img, next_img) if transition_type == "Grow" else (next_img, prev_img)
+            scale = i / num_frames if transition_type == "Grow" else 1 - (i / num_frames)
+            size = (int(source.width * scale), int(source.height * scale))
+            if size[0] > 0 and size[1] > 0:
+                frame = Image.new('RGB', background.size)
+                frame.paste(background)
+                frame.paste(source.resize(size, Image.LANCZOS), ((width - size[0]) // 2, (height - size[1]) // 2))
+                yield frame
+            continue
+
+        frame = Image.new('RGB', prev_img.size)
+        length = height if transition_type in ("Slide up", "Slide down") else width
+        offset = int((i / num_frames) * length)
+        if transition_type == "Slide up":
+            frame.paste(prev_img, (0, -offset))
+            frame.paste(next_img, (0, height - offset))
+        elif transition_type == "Slide down":
+            frame.paste(prev_img, (0, offset))
+            frame.paste(next_img, (0, -(height - offset)))
+        elif transition_type == "Slide right":
+            frame.paste(prev_img, (-offset, 0))
+            frame.paste(next_img, (width - offset, 0))
+        else:
+            frame.paste(prev_img, (offset, 0))
+            frame.paste(next_img, (-(width - offset), 0))
+        yield frame
+
+
+def _overlay_frames(prev_img, next_img, transition_type, num_frames):
+    # The old overlay transitions of api/app.py
+    width, height = prev_img.size
+    for i in range(num_frames):
+        if transition_type == "Fade in":
+            frame = Image.blend(prev_img.convert("RGBA"), next_img.convert("RGBA"), i / num_frames)
+            yield frame.convert("RGB")
+            continue
+
+        frame = Image.new("RGB", prev_img.size, (255, 255, 255))
+        if transition_type == "Slide up":
+            offset = int(height * (1 - i / num_frames))
+            frame.paste(prev_img, (0, 0))
+            frame.paste(next_img.crop((0, 0, width, height - offset)), (0, offset))
+        elif transition_type == "Slide down":
+            offset = int(height * (i / num_frames))
+            frame.paste(prev_img, (0, 0))
+            frame.paste(next_img.crop((0, offset, width, height)), (0, 0))
+        elif transition_type == "Slide right":
+            offset = int(width * (1 - i / num_frames))
+            frame.paste(prev_img, (0, 0))
+            frame.paste(next_img.crop((0, 0, width - offset, height)), (offset, 0))
+        elif transition_type == "Slide left":
+            offset = int(width * (i / num_frames))
+            frame.paste(prev_img, (0, 0))
+            frame.paste(next_img.crop((offset, 0, width, height)), (0, 0))
+        elif transition_type == "Grow":
+            scale = i / num_frames
+            new_width, new_height = int(width * scale), int(height * scale)
+            frame.paste(prev_img, (0, 0))
+            if new_width > 0 and new_height > 0:
+                frame.paste(next_img.resize((new_width, new_height), Image.LANCZOS),
+                            ((width - new_width) // 2, (height - new_height) // 2))
+        else:
+            scale = 1 - (i / num_frames)
+            new_width, new_height = max(1, int(width * scale)), max(1, int(height * scale))
+            frame.paste(next_img, (0, 0))
+            frame.paste(prev_img.resize((new_width, new_height), Image.LANCZOS),
+                        ((width - new_width) // 2, (height - new_height) // 2))
+        yield frame
+
+
+def _assert_same_frames(frames, expected):
+    frames, expected = list(frames), list(expected)
+    assert len(frames) == len(expected)
+    for index, (frame, reference) in enumerate(zip(frames, expected)):
+        assert frame.mode == "RGB" and frame.size == reference.size, index
+        assert np.array_equal(np.asarray(frame), np.asarray(reference)), f"frame {index} differs"
+
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("num_frames", NUM_FRAMES)
+@pytest.mark.parametrize("transition_type", TRANSITION_TYPES)
+@pytest.mark.parametrize("overlay", (False, True))
+def test_frames_match_pillow(overlay, transition_type, num_frames, size):
+    prev_img, next_img = _image(size, 1), _image(size, 2)
+    reference = _overlay_frames if overlay else _push_frames
+    frames = iter_transition_frames(prev_img, next_img, transition_type, num_frames, overlay=overlay,
+                                    scale_quality='exact')
+    _assert_same_frames(frames, reference(prev_img, next_img, transition_type, num_frames))
+
+
+@pytest.mark.parametrize("transition_type", ("Fade in", "Slide up", "Slide left"))
+@pytest.mark.parametrize("overlay", (False, True))
+def test_batches_match_frames(overlay, transition_type):
+    # The batched arrays are the same frames the one-by-one paths yield
+    prev_img, next_img = _image((37, 23), 3), _image((37, 23), 4)
+    transition = Transition(prev_img, next_img, transition_type, 15, overlay=overlay)
+    batch = transition.batch(range(15))
+    _assert_same_frames(transition.frames(), [Image.fromarray(frame) for frame in batch])
+
+
+def test_fade_matches_blend_on_every_pair_of_values():
+    # Every pair of channel values, so no rounding case is left out
+    values = np.arange(256, dtype=np.uint8)
+    prev = np.repeat(values, 256).reshape(256, 256, 1).repeat(3, axis=2)
+    prev_img = Image.fromarray(np.ascontiguousarray(prev))
+    next_img = Image.fromarray(np.ascontiguousarray(prev.transpose(1, 0, 2)))
+    for num_frames in (7, 15, 30):
+        frames = iter_transition_frames(prev_img, next_img, "Fade in", num_frames)
+        _assert_same_frames(frames, _push_frames(prev_img, next_img, "Fade in", num_frames))
+
+
+@pytest.mark.parametrize("size", ((37, 23), (5, 3), (1, 1)))
+@pytest.mark.parametrize("transition_type", TRANSITION_TYPES + ["Instant"])
+@pytest.mark.parametrize("overlay", (False, True))
+def test_frame_count_matches_frames(overlay, transition_type, size):
+    prev_img, next_img = _image(size, 5), _image(size, 6)
+    for num_frames in (0, 1, 7, 15, 40):
+        frames = list(iter_transition_frames(prev_img, next_img, transition_type, num_frames, overlay=overlay))
+        assert transition_frame_count(size, transition_type, num_frames, overlay=overlay) == len(frames)